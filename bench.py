@@ -0,0 +1,350 @@
+"""Бенчмарк бота на синтетических данных.
+
+Для каждого режима хранения и размера базы создается временный каталог с
+синтетическими clients_cheer4.json и историей посещений, после чего в
+отдельном процессе (у main.py состояние на уровне модуля) замеряются:
+загрузка, mark_attendance, add_sessions_to_client, clients_list_keyboard,
+reminders_text, send_reminders, send_monthly_report и обработка нажатий
+handle_callback целиком - через Application и локальную заглушку Telegram
+Bot API. Паузы очереди исходящих сообщений в замерах отключены.
+
+Результат - JSON, который удобно сравнивать между версиями и режимами:
+
+    python bench.py --sizes 100,1000,10000 --backends json,journal,sqlite,sharded --output bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_TOKEN = "123456:bench"
+BENCH_CHAT_ID = 42
+
+FIRST_NAMES = ("Алиса", "Анна", "Варвара", "Вероника", "Дарья", "Ева", "Екатерина", "Злата", "Ирина",
+               "Кира", "Ксения", "Лиза", "Мария", "Милана", "Надежда", "Ольга", "Полина", "София",
+               "Таисия", "Ульяна", "Юлия", "Яна", "Артем", "Максим", "Никита", "Тимофей")
+LAST_NAMES = ("Иванова", "Смирнова", "Кузнецова", "Попова", "Васильева", "Петрова", "Соколова",
+              "Михайлова", "Новикова", "Федорова", "Морозова", "Волкова", "Алексеева", "Лебедева",
+              "Семенова", "Егорова", "Павлова", "Козлова", "Степанова", "Николаева", "Орлова",
+              "Андреева", "Макарова", "Никитина", "Захарова", "Зайцева", "Соловьева", "Борисова")
+GROUP_NAMES = ("Малыши", "Младшая", "Средняя", "Старшая", "Юниоры", "Сборная", "Партерная",
+               "Групповые станты", "Прыжки", "Взрослые")
+
+# ==================== СИНТЕТИЧЕСКИЕ ДАННЫЕ ====================
+
+def generate_dataset(main, size, rng, now):
+    """Пишет clients_cheer4.json и файл истории на size клиентов.
+
+    Каждый клиент ходит с собственной частотой (от раза в две недели до
+    трех раз в неделю) последние 1-6 месяцев и платит за абонемент из 8
+    занятий; остаток и даты последних оплаты и посещения согласованы с историей.
+    Клиенты распределены по группам GROUP_NAMES.
+    """
+    clients = {}
+    history = bytearray()
+    record = main.ClientHistory.RECORD
+    now_ts = int(now.timestamp())
+    for client_id in range(1, size + 1):
+        client_name = f"{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)}"
+        if client_name in clients:
+            client_name = f"{client_name} {client_id}"
+        per_day = rng.uniform(0.5, 3) / 7
+        moment = now_ts - rng.randint(30, 180) * 86400
+        visits, payments = [], [moment]
+        while True:
+            moment += int(rng.expovariate(per_day) * 86400) + 3600
+            if moment >= now_ts:
+                break
+            if len(visits) % 8 == 7:
+                payments.append(moment - 600)
+            visits.append(moment)
+        for moment in payments:
+            history += record.pack(client_id, main.ClientHistory.PAYMENT, moment)
+        for moment in visits:
+            history += record.pack(client_id, main.ClientHistory.ATTEND, moment)
+        client = {
+            'sessions': 8 - len(visits) % 8 if rng.random() > 0.1 else 0,
+            'last_payment_date': datetime.fromtimestamp(payments[-1]).isoformat(),
+            'phone': f"+79{rng.randint(0, 10 ** 9 - 1):09d}",
+            'notes': rng.choice(("", "", "", "сестра в младшей группе", "оплата наличными")),
+            'id': client_id,
+            'group': rng.choice(GROUP_NAMES),
+        }
+        if visits:
+            client['last_attendance'] = datetime.fromtimestamp(visits[-1]).isoformat()
+        clients[client_name] = client
+    with open(main.DATA_FILE, 'w', encoding='utf-8') as f:
+        f.write(main.dump_data(clients))
+    with open(main.HISTORY_FILE, 'wb') as f:
+        f.write(history)
+    return len(history) // record.size
+
+# ==================== ЗАГЛУШКА TELEGRAM BOT API ====================
+
+class FakeBotApi:
+    """Локальный HTTP-сервер, отвечающий на вызовы Bot API как Telegram.
+
+    Поддерживает keep-alive, чтобы время соединения не искажало замеры.
+    Считает вызовы по методам.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.message_id = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/bot"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _result(self, method):
+        if method == 'getme':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method in ('sendmessage', 'editmessagetext', 'senddocument'):
+            self.message_id += 1
+            return {'message_id': self.message_id, 'date': int(time.time()),
+                    'chat': {'id': BENCH_CHAT_ID, 'type': 'private'}, 'text': ''}
+        return True
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                if length:
+                    await reader.readexactly(length)
+                method = request_line.split()[1].decode('latin-1').rsplit('/', 1)[-1].lower()
+                self.calls[method] = self.calls.get(method, 0) + 1
+                body = json.dumps({'ok': True, 'result': self._result(method)}).encode('utf-8')
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+# ==================== ЗАМЕРЫ ====================
+
+def summarize(samples):
+    """Статистика по длительностям в секундах: миллисекунды, перцентили."""
+    samples = sorted(samples)
+    count = len(samples)
+    if not count:
+        return {'n': 0}
+    return {
+        'n': count,
+        'total_ms': round(sum(samples) * 1000, 3),
+        'mean_ms': round(sum(samples) / count * 1000, 4),
+        'p50_ms': round(samples[count // 2] * 1000, 4),
+        'p95_ms': round(samples[min(count - 1, int(count * 0.95))] * 1000, 4),
+        'max_ms': round(samples[-1] * 1000, 4),
+    }
+
+def storage_bytes_written(main):
+    """Байт, записанных хранилищем и историей с начала работы процесса."""
+    return sum(value for (name, _), value in main.metrics.counters.items() if name == 'storage_bytes_written_total')
+
+async def timed_calls(func, args):
+    """Вызывает корутину func(arg) для каждого аргумента и замеряет каждый вызов."""
+    samples = []
+    for arg in args:
+        started = time.perf_counter()
+        await func(arg)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def timed_sync(func, args):
+    samples = []
+    for arg in args:
+        started = time.perf_counter()
+        func(arg)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def callback_update(update_id, data):
+    """Обновление Telegram с нажатием кнопки data."""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': BENCH_CHAT_ID, 'is_bot': False, 'first_name': 'Bench'},
+            'chat_instance': 'bench',
+            'data': data,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': BENCH_CHAT_ID, 'type': 'private'},
+                'text': 'menu',
+            },
+        },
+    }
+
+async def run_worker(size, operations, seed):
+    """Замеры для одного размера базы; режим хранения задан в STORAGE_MODE."""
+    sys.path.insert(0, REPO_DIR)
+    import main
+    from telegram import Update
+    logging.getLogger('httpx').setLevel(logging.WARNING)  # Не логировать каждый вызов заглушки
+
+    rng = random.Random(seed)
+    results = {}
+    started = time.perf_counter()
+    events = generate_dataset(main, size, rng, datetime.now())
+    if main.STORAGE_MODE == 'sqlite':
+        main.migrate_json_to_sqlite()
+    results['generate'] = {'seconds': round(time.perf_counter() - started, 3), 'history_events': events}
+
+    started = time.perf_counter()
+    main.store.load()
+    results['load'] = summarize([time.perf_counter() - started])
+    results['load_data'] = summarize(timed_sync(lambda _: main.load_data(), range(operations)))
+
+    api = FakeBotApi()
+    base_url = await api.start()
+    application = main.build_application(main.InstrumentedBot(BENCH_TOKEN, base_url=base_url))
+    await application.initialize()
+
+    names = list(main.store.clients)
+    written = storage_bytes_written(main)
+    results['mark_attendance'] = summarize(
+        await timed_calls(main.mark_attendance, [rng.choice(names) for _ in range(operations)]))
+    await main.store.flush()
+    # Сколько байт записано на диск ради отметок (SQLite считает строки, а не байты)
+    results['mark_attendance_bytes_written'] = storage_bytes_written(main) - written
+    results['add_sessions_to_client'] = summarize(
+        await timed_calls(lambda name: main.add_sessions_to_client(name, 8), [rng.choice(names) for _ in range(operations)]))
+    started = time.perf_counter()
+    await main.store.flush()
+    results['flush'] = summarize([time.perf_counter() - started])
+
+    pages = [rng.randrange(main.store.page_count(main.CLIENTS_PAGE_SIZE)) for _ in range(operations)]
+    main.render_cache.entries.clear()
+    main.store.version += 1  # Все страницы строятся заново
+    results['clients_list_keyboard_cold'] = summarize(timed_sync(main.clients_list_keyboard, pages))
+    results['clients_list_keyboard_warm'] = summarize(timed_sync(main.clients_list_keyboard, pages))
+
+    # Отправка в заглушку идет без пауз OutboundQueue (их отключает run_case),
+    # а сборка текста замеряется еще и отдельно от отправки
+    repeats = max(3, operations // 20)
+    results['reminders_text'] = summarize(timed_sync(lambda _: main.reminders_text(), range(repeats)))
+    results['send_reminders'] = summarize(
+        await timed_calls(lambda _: main.send_reminders(application), range(repeats)))
+    results['send_monthly_report'] = summarize(
+        await timed_calls(lambda _: main.send_monthly_report(application), range(repeats)))
+
+    # Нажатия кнопок целиком: разбор обновления, обработчик, вызовы Bot API
+    by_action = {}
+    update_id = 0
+    for _ in range(operations):
+        client_id = rng.randint(1, size)
+        client_name = main.store.name_of(client_id)
+        if client_name is None:
+            continue
+        page = main.store.page_of(client_name, main.CLIENTS_PAGE_SIZE)
+        for data in (f"l:{page}", f"c:{client_id}", f"i:{client_id}", f"h:{client_id}", f"a:{client_id}"):
+            update_id += 1
+            update = Update.de_json(callback_update(update_id, data), application.bot)
+            started = time.perf_counter()
+            await application.process_update(update)
+            by_action.setdefault(data.partition(':')[0], []).append(time.perf_counter() - started)
+    results['handle_callback'] = summarize([sample for samples in by_action.values() for sample in samples])
+    results['handle_callback_by_action'] = {action: summarize(samples) for action, samples in by_action.items()}
+    results['api_calls'] = api.calls
+
+    await application.shutdown()
+    await main.store.flush()
+    await api.stop()
+    main.store.close()
+    return results
+
+# ==================== ЗАПУСК ====================
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_case(backend, size, operations, seed):
+    """Запускает замеры в отдельном процессе во временном каталоге."""
+    with tempfile.TemporaryDirectory(prefix='cheer4-bench-') as workdir:
+        result_file = os.path.join(workdir, 'result.json')
+        env = dict(os.environ, STORAGE_MODE=backend, BOT_TOKEN=BENCH_TOKEN,
+                   ADMIN_CHAT_ID=str(BENCH_CHAT_ID), SAVE_DELAY='0',
+                   SEND_RATE='0', CHAT_SEND_INTERVAL='0', GROUP_SEND_INTERVAL='0')
+        command = [sys.executable, os.path.abspath(__file__), '--worker', '--sizes', str(size),
+                   '--operations', str(operations), '--seed', str(seed), '--output', result_file]
+        # Вывод бота (print) не нужен, ошибки остаются в stderr
+        subprocess.run(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, check=True)
+        with open(result_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк бота на синтетических данных")
+    parser.add_argument('--sizes', default='100,1000,10000,100000', help="размеры базы через запятую")
+    parser.add_argument('--backends', default='json,journal,sqlite,sharded', help="режимы хранения через запятую")
+    parser.add_argument('--operations', type=int, default=200, help="замеров на каждую операцию")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="файл для JSON (по умолчанию stdout)")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    if args.worker:
+        results = asyncio.run(run_worker(sizes[0], args.operations, args.seed))
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f)
+        return
+
+    report = {
+        'meta': {
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'operations': args.operations,
+            'seed': args.seed,
+        },
+        'results': [],
+    }
+    for backend in args.backends.split(','):
+        for size in sizes:
+            print(f"⏱ {backend}: {size} клиентов", file=sys.stderr)
+            results = run_case(backend, size, args.operations, args.seed)
+            report['results'].append({'backend': backend, 'clients': size, **results})
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,61 @@
 import logging
 import json
 import os
+import sys
+import sqlite3
+import csv
+import tempfile
 import asyncio
-from datetime import datetime, timedelta
+import contextlib
+import bisect
+import heapq
+import itertools
+import math
+import hmac
+import secrets
+import signal
+import time
+import struct
+import threading
+import functools
+import shutil
+import urllib.parse
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, OrderedDict
+from datetime import datetime, timedelta, time as dt_time
+import numpy as np
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import (Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes,
+                          ExtBot, MessageHandler, TypeHandler, filters)
 from dotenv import load_dotenv
-from flask import Flask
-from threading import Thread
-
-# ==================== ВЕБ-СЕРВЕР ДЛЯ ПОДДЕРЖАНИЯ АКТИВНОСТИ ====================
-
-app = Flask('')
-
-@app.route('/')
-def home():
-    return "Бот активен!"
-
-def run_flask():
-    app.run(host='0.0.0.0', port=8080)
-
-def keep_alive():
-    t = Thread(target=run_flask)
-    t.start()
 
 # ==================== ЗАГРУЗКА ТОКЕНА ИЗ .ENV ====================
 
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')  # Ваш chat_id для отчетов
+# Дополнительные получатели напоминаний и отчетов (тренеры) через запятую
+REPORT_CHAT_IDS = list(dict.fromkeys(
+    chat_id.strip()
+    for chat_id in [ADMIN_CHAT_ID or '', *os.getenv('REPORT_CHAT_IDS', '').split(',')]
+    if chat_id.strip()
+))
+
+def parse_group_chats(value):
+    """Разбирает "Группа=chat_id,chat_id;Другая группа=chat_id" в {группа: [chat_id]}."""
+    group_chats = {}
+    for item in value.split(';'):
+        group, _, chat_ids = item.partition('=')
+        chat_ids = [chat_id.strip() for chat_id in chat_ids.split(',') if chat_id.strip()]
+        if group.strip() and chat_ids:
+            group_chats[group.strip()] = chat_ids
+    return group_chats
+
+# Тренеры групп: им уходят напоминания и отчеты только по их группе
+GROUP_CHAT_IDS = parse_group_chats(os.getenv('GROUP_CHAT_IDS', ''))
 
 if not BOT_TOKEN:
     print("❌ Ошибка: Токен бота не найден. Проверьте файл .env")
@@ -39,6 +66,38 @@ if not BOT_TOKEN:
 DATA_FILE = "clients_cheer4.json"
 REMINDER_THRESHOLD = 1  # Напоминать когда осталось 1 занятие
 REPORT_HOUR = 10        # Время отправки отчета (10:00)
+# Расписания в формате cron: минуты, часы, дни месяца (L - последний), месяцы, дни недели
+REMINDER_SCHEDULE = os.getenv('REMINDER_SCHEDULE', f'0 {REPORT_HOUR} * * *')  # Ежедневные напоминания
+REPORT_SCHEDULE = os.getenv('REPORT_SCHEDULE', f'0 {REPORT_HOUR} L * *')       # Отчет в последний день месяца
+SCHEDULER_STATE_FILE = "scheduler_cheer4.json"  # Время последних запусков задач
+CLIENTS_PAGE_SIZE = 20  # Клиентов на одной странице списка
+SAVE_DELAY = float(os.getenv('SAVE_DELAY', '2'))  # Задержка записи изменений на диск (сек)
+STORAGE_MODE = os.getenv('STORAGE_MODE', 'json')  # json - перезапись файла, journal - журнал изменений, sqlite - база SQLite, sharded - файл на группу
+JOURNAL_FILE = "clients_cheer4.journal"
+JOURNAL_COMPACT_BYTES = int(os.getenv('JOURNAL_COMPACT_BYTES', str(1024 * 1024)))  # Порог сжатия журнала
+SQLITE_FILE = "clients_cheer4.db"  # База для STORAGE_MODE=sqlite
+SHARDS_DIR = "clients_cheer4.shards"  # Файлы групп для STORAGE_MODE=sharded
+CHECKIN_GROUPS_FILE = "groups_cheer4.json"  # Сохраненные группы для групповой отметки
+HISTORY_FILE = "history_cheer4.bin"  # История оплат и посещений клиентов
+RENDER_CACHE_SIZE = 512  # Сколько готовых клавиатур и текстов экранов держать в памяти
+HTTP_HOST = os.getenv('HTTP_HOST', '0.0.0.0')
+HTTP_PORT = int(os.getenv('HTTP_PORT', '8080'))  # /healthz и /metrics для мониторинга
+HTTP_TIMEOUT = 10  # Сколько ждать запроса от HTTP-клиента (сек)
+HTTP_MAX_BODY = 1024 * 1024  # Максимальный размер тела HTTP-запроса
+SCHEDULER_STALL_SECONDS = 300  # Насколько задача может опоздать, прежде чем /healthz сообщит о сбое
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', '') == '1'  # Разрешить /debug/profile
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling - опрос Telegram, webhook - Telegram сам присылает обновления
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Внешний адрес HTTP-сервера бота, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Если не задан, создается при каждом запуске
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '8'))  # Сколько обновлений обрабатывать одновременно
+FORECAST_WINDOW_DAYS = 28  # За сколько дней считать частоту посещений для прогноза
+SEARCH_LIMIT = 10  # Сколько клиентов показывать в результатах поиска
+MESSAGE_LIMIT = 4096  # Максимальная длина сообщения в Telegram
+SEND_RATE = float(os.getenv('SEND_RATE', '25'))  # Сообщений в секунду на всех получателей (лимит Telegram - 30; 0 - без ограничения)
+CHAT_SEND_INTERVAL = float(os.getenv('CHAT_SEND_INTERVAL', '1'))  # Пауза между сообщениями в личный чат (сек)
+GROUP_SEND_INTERVAL = float(os.getenv('GROUP_SEND_INTERVAL', '3'))  # Пауза между сообщениями в группу: не больше 20 в минуту
+SEND_ATTEMPTS = 5  # Сколько раз пробовать отправить сообщение при сетевых ошибках
 
 # ==================== НАСТРОЙКА ЛОГИРОВАНИЯ ====================
 
@@ -48,74 +107,1537 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ==================== МЕТРИКИ ====================
+
+class Metrics:
+    """Счетчики и гистограммы времени работы бота для /metrics.
+
+    Обновляются и из цикла событий, и из потока хранилища, поэтому
+    изменения идут под блокировкой. Метрика задается именем и метками
+    (action, op и т.п.); отдаются в текстовом формате Prometheus.
+    """
+
+    PREFIX = 'cheer4_'
+    # Верхние границы корзин гистограмм, секунды
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.started = time.time()
+        self.last_update = None  # Время последнего обновления от Telegram
+        self.counters = defaultdict(int)  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [[количество по корзинам, последняя - +Inf], сумма секунд]
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Увеличивает счетчик."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += value
+
+    def observe(self, name, seconds, **labels):
+        """Учитывает длительность операции в гистограмме."""
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Замеряет длительность блока with."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        escaped = (
+            (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels
+        )
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+    def render(self, gauges):
+        """Текст для /metrics; gauges - текущие значения {имя: число}."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), total)) for key, (buckets, total) in self.histograms.items())
+        lines = []
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE {self.PREFIX}{name} gauge")
+            lines.append(f"{self.PREFIX}{name} {value}")
+        for name, group in itertools.groupby(counters, key=lambda item: item[0][0]):
+            lines.append(f"# TYPE {self.PREFIX}{name} counter")
+            for (_, labels), value in group:
+                lines.append(f"{self.PREFIX}{name}{self._labels(labels)} {value}")
+        for name, group in itertools.groupby(histograms, key=lambda item: item[0][0]):
+            metric = f"{self.PREFIX}{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for (_, labels), (buckets, total) in group:
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), buckets):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{metric}_sum{self._labels(labels)} {total:.6f}")
+                lines.append(f"{metric}_count{self._labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def timed(name, **labels):
+    """Декоратор: замеряет время выполнения корутины в гистограмме name."""
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metrics.timer(name, **labels):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class SamplingProfiler:
+    """Выборочный профилировщик потока цикла событий.
+
+    Включается на время по запросу (/debug/profile): отдельный поток каждые
+    interval секунд снимает стек потока цикла событий через
+    sys._current_frames() и считает одинаковые стеки. Результат - строки
+    "функция;функция;... количество" (формат flamegraph), самые частые сверху.
+    Пока профилировщик выключен, он ничего не стоит.
+    """
+
+    def __init__(self):
+        self.active = False
+
+    def _sample(self, thread_id, interval, duration, stacks):
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+
+    async def profile(self, duration, interval=0.005, top=50):
+        """Профилирует цикл событий duration секунд и возвращает самые частые стеки."""
+        if self.active:
+            raise RuntimeError("Профилирование уже идет")
+        self.active = True
+        stacks = defaultdict(int)
+        try:
+            await asyncio.to_thread(self._sample, threading.get_ident(), interval, duration, stacks)
+        finally:
+            self.active = False
+        ranked = sorted(stacks.items(), key=lambda item: item[1], reverse=True)[:top]
+        return "\n".join(f"{stack} {count}" for stack, count in ranked) + "\n"
+
+profiler = SamplingProfiler()
+
 # ==================== РАБОТА С ДАННЫМИ ====================
 
-def load_data():
-    """Загружает данные о клиентах из JSON-файла."""
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-                return convert_to_new_format(data)
-            except json.JSONDecodeError:
-                return {}
-    return {}
-
-def convert_to_new_format(data):
-    """Конвертирует старый формат данных в новый с датами."""
-    new_data = {}
-    for client_name, client_data in data.items():
-        if isinstance(client_data, dict):
-            new_data[client_name] = client_data
-        else:
-            new_data[client_name] = {
+def migrate_sessions_to_records(clients):
+    """Версия 0 -> 1: у клиента было только число занятий, без дат и контактов."""
+    now = datetime.now().isoformat()
+    for client_name, client_data in clients.items():
+        if not isinstance(client_data, dict):
+            clients[client_name] = {
                 'sessions': client_data,
-                'last_payment_date': datetime.now().isoformat(),
+                'last_payment_date': now,
                 'phone': '',
                 'notes': ''
             }
-    return new_data
+    return clients
 
-def save_data(data):
-    """Сохраняет данные о клиентах в JSON-файл."""
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+# Шаги обновления формата данных: шаг с индексом i переводит клиентов из
+# версии i в версию i + 1. Изменение формата (новое поле, другой вид дат)
+# добавляется новой функцией в конец списка.
+DATA_MIGRATIONS = [migrate_sessions_to_records]
+SCHEMA_VERSION = len(DATA_MIGRATIONS)
 
-def add_sessions_to_client(client_name, sessions_to_add, phone="", notes=""):
-    """Добавляет занятия абонемента клиенту."""
-    data = load_data()
-    if client_name in data:
-        data[client_name]['sessions'] += sessions_to_add
-        data[client_name]['last_payment_date'] = datetime.now().isoformat()
-        if phone:
-            data[client_name]['phone'] = phone
-        if notes:
-            data[client_name]['notes'] = notes
-    else:
-        data[client_name] = {
-            'sessions': sessions_to_add,
-            'last_payment_date': datetime.now().isoformat(),
+def read_data_file(path):
+    """Читает данные о клиентах из JSON-файла: (версия формата, клиенты, next_id).
+
+    Файл имеет вид {"schema_version": N, "next_id": K, "clients": {...}};
+    next_id - следующий свободный id клиента (0, если он не записан). Файл
+    без версии - это словарь клиентов версии 0. Нет файла или он поврежден -
+    пустые данные.
+    """
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError:
+                return SCHEMA_VERSION, {}, 0
+        if isinstance(data.get('schema_version'), int) and isinstance(data.get('clients'), dict):
+            next_id = data.get('next_id')
+            return data['schema_version'], data['clients'], next_id if isinstance(next_id, int) else 0
+        return 0, data, 0
+    return SCHEMA_VERSION, {}, 0
+
+def upgrade_data(version, clients):
+    """Переводит клиентов из версии формата version в SCHEMA_VERSION."""
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"Данные в формате версии {version}, бот поддерживает до {SCHEMA_VERSION}")
+    for migrate in DATA_MIGRATIONS[version:]:
+        clients = migrate(clients)
+    return clients
+
+def to_epoch(iso_date):
+    """Переводит дату ISO в секунды epoch; пустая дата дает 0."""
+    if not iso_date:
+        return 0
+    return int(datetime.fromisoformat(iso_date).timestamp())
+
+def from_epoch(moment):
+    """Переводит секунды epoch в дату ISO; 0 дает None."""
+    if not moment:
+        return None
+    return datetime.fromtimestamp(moment).isoformat()
+
+class Client:
+    """Запись клиента в памяти.
+
+    Объект со __slots__ вместо словаря: у записи нет собственного словаря
+    атрибутов и ключей-строк, а даты хранятся секундами epoch (0 - даты
+    нет), так что их не нужно разбирать из ISO при каждом показе или
+    сравнении. В файлы, журнал и базу запись уходит словарем прежнего вида.
+    """
+
+    __slots__ = ('id', 'sessions', 'paid_at', 'attended_at', 'phone', 'notes', 'group')
+
+    def __init__(self, sessions=0, paid_at=0, attended_at=0, phone='', notes='', client_id=None, group=''):
+        self.id = client_id
+        self.sessions = sessions
+        self.paid_at = paid_at
+        self.attended_at = attended_at
+        self.phone = phone
+        # Одинаковые заметки ("оплата наличными") и группы хранятся одной строкой
+        self.notes = sys.intern(notes) if notes else ''
+        self.group = sys.intern(group) if group else ''
+
+    @classmethod
+    def from_dict(cls, data):
+        """Запись из словаря формата clients_cheer4.json."""
+        return cls(
+            data['sessions'],
+            to_epoch(data.get('last_payment_date')),
+            to_epoch(data.get('last_attendance')),
+            data.get('phone') or '',
+            data.get('notes') or '',
+            data.get('id'),
+            data.get('group') or '',
+        )
+
+    def state(self):
+        """Копия полей кортежем: снимается быстро, в словарь переводится позже."""
+        return (self.sessions, self.paid_at, self.attended_at, self.phone, self.notes, self.id, self.group)
+
+    @staticmethod
+    def state_to_dict(state):
+        """Словарь формата clients_cheer4.json из копии полей."""
+        sessions, paid_at, attended_at, phone, notes, client_id, group = state
+        data = {
+            'sessions': sessions,
+            'last_payment_date': from_epoch(paid_at),
             'phone': phone,
             'notes': notes
         }
-    save_data(data)
+        if attended_at:
+            data['last_attendance'] = from_epoch(attended_at)
+        if client_id is not None:
+            data['id'] = client_id
+        if group:
+            data['group'] = group
+        return data
+
+    def to_dict(self):
+        """Словарь формата clients_cheer4.json."""
+        return self.state_to_dict(self.state())
+
+def dump_data(data, next_id=0):
+    """Сериализует данные о клиентах в текст JSON-файла текущей версии формата."""
+    content = {'schema_version': SCHEMA_VERSION}
+    if next_id:
+        content['next_id'] = next_id
+    content['clients'] = data
+    return json.dumps(content, ensure_ascii=False, indent=4)
+
+def atomic_write(path, text):
+    """Записывает файл целиком через временный файл и os.replace.
+
+    При сбое посреди записи на диске остается либо старая, либо новая версия
+    файла, но никогда не обрезанная.
+    """
+    tmp_path = path + '.tmp'
+    data = text.encode('utf-8')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    metrics.inc('storage_bytes_written_total', len(data), file=os.path.basename(path))
+
+def save_data(data, next_id=0):
+    """Сохраняет данные о клиентах в JSON-файл."""
+    atomic_write(DATA_FILE, dump_data(data, next_id))
+
+class Storage:
+    """Интерфейс хранилища клиентов.
+
+    Методы синхронные: ClientStore вызывает их в отдельном потоке хранилища,
+    по одному и в том порядке, в каком сделаны изменения. load() возвращает
+    словарь всех клиентов, record() сохраняет изменение одного клиента
+    (op: topup, attend, delete; client - копия записи или None при удалении),
+    record_many() - изменения нескольких клиентов одной записью.
+    Когда snapshot_due() возвращает True, через snapshot_delay секунд
+    ClientStore передает копию клиентов в write_snapshot(). Хранилище с
+    by_groups = True получает снимок не по snapshot_due(), а когда в
+    ClientStore есть измененные группы, и только клиентов этих групп
+    (groups - их названия; None - переданы все клиенты).
+    write_all() записывает всех клиентов сразу, например после того как при
+    загрузке им были выданы id.
+    next_id - следующий свободный id клиента. Хранилище поднимает его по
+    всем клиентам, которых видит, и сохраняет вместе с данными, чтобы id
+    удаленного клиента не достался новому после перезапуска.
+    """
+
+    snapshot_delay = 0
+    by_groups = False
+    next_id = 1
+
+    def load(self):
+        raise NotImplementedError
+
+    def record(self, op, client_name, client):
+        pass
+
+    def record_many(self, op, changes):
+        """Сохраняет изменения [(имя, копия записи)] нескольких клиентов."""
+        for client_name, client in changes:
+            self.record(op, client_name, client)
+
+    def snapshot_due(self):
+        return False
+
+    def write_snapshot(self, clients, groups=None):
+        pass
+
+    def write_all(self, clients):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _see_ids(self, clients):
+        """Поднимает next_id выше id переданных копий клиентов (None пропускаются)."""
+        for client in clients:
+            if client is not None and client.get('id') is not None and client['id'] >= self.next_id:
+                self.next_id = client['id'] + 1
+
+class JsonFileStorage(Storage):
+    """Хранение в одном JSON-файле, который перезаписывается целиком.
+
+    Отдельные изменения не пишутся: через save_delay секунд после первого
+    изменения файл перезаписывается снимком со всеми изменениями за это время.
+    """
+
+    def __init__(self, save_delay):
+        self.snapshot_delay = save_delay
+        self._dirty = False
+
+    def load(self):
+        """Читает всех клиентов из файла; файл старого формата обновляется один раз."""
+        self._dirty = False
+        version, clients, self.next_id = read_data_file(DATA_FILE)
+        self._see_ids(clients.values())
+        if version != SCHEMA_VERSION:
+            clients = upgrade_data(version, clients)
+            save_data(clients, self.next_id)
+            print(f"✅ Файл {DATA_FILE} обновлен с версии формата {version} до {SCHEMA_VERSION}")
+        return clients
+
+    def record(self, op, client_name, client):
+        self._see_ids([client])
+        self._dirty = True
+
+    def snapshot_due(self):
+        return self._dirty
+
+    def write_snapshot(self, clients, groups=None):
+        """Перезаписывает файл всеми клиентами.
+
+        Если запись не удалась, файл остается помеченным к записи: снимок
+        повторится по таймеру или при закрытии хранилища.
+        """
+        self._dirty = False
+        self._see_ids(clients.values())
+        try:
+            save_data(clients, self.next_id)
+        except BaseException:
+            self._dirty = True
+            raise
+
+    def write_all(self, clients):
+        self.write_snapshot(clients)
+
+class JournalStorage(Storage):
+    """Снимок в DATA_FILE плюс журнал изменений, куда дописывается по строке.
+
+    Каждая запись журнала содержит итоговое состояние клиента (или факт
+    удаления), поэтому повторное применение записи ничего не портит. Пакет
+    изменений пишется одной строкой и применяется целиком или не применяется
+    вовсе, если строка не успела записаться. Когда
+    журнал вырастает больше compact_bytes, он переименовывается в
+    JOURNAL_FILE.old, отдельный поток пишет новый снимок и удаляет старый
+    журнал. Если снимок записать не удалось, старый журнал остается на
+    диске, следующее сжатие дописывает к нему текущий журнал и повторяет
+    снимок. При загрузке снимок дополняется записями из обоих журналов.
+    """
+
+    def __init__(self, compact_bytes):
+        self.compact_bytes = compact_bytes
+        self.old_journal = JOURNAL_FILE + '.old'
+        self._journal = None
+        self._compactor = None
+        self.compact_pending = False  # Старый журнал еще не вошел в снимок
+
+    def load(self):
+        """Восстанавливает клиентов из снимка и журнала.
+
+        Записи журнала сделаны в формате снимка, поэтому обновление формата
+        применяется уже к результату проигрывания журнала.
+        """
+        self.close()
+        self.compact_pending = False
+        version, clients, self.next_id = read_data_file(DATA_FILE)
+        self._see_ids(clients.values())
+        replayed = 0
+        for path in (self.old_journal, JOURNAL_FILE):
+            replayed += self._replay(path, clients)
+        if version != SCHEMA_VERSION:
+            clients = upgrade_data(version, clients)
+            print(f"✅ Файл {DATA_FILE} обновлен с версии формата {version} до {SCHEMA_VERSION}")
+        if replayed or version != SCHEMA_VERSION:
+            # Сворачиваем журнал сразу, чтобы не проигрывать его при каждом запуске
+            atomic_write(DATA_FILE, dump_data(clients, self.next_id))
+            self._remove_journals()
+        if replayed:
+            print(f"✅ Применено записей журнала: {replayed}")
+        self._open_journal()
+        return clients
+
+    def _open_journal(self):
+        self._journal = open(JOURNAL_FILE, 'ab')
+        self.journal_bytes = self._journal.tell()
+
+    def _replay(self, path, clients):
+        """Применяет записи журнала к словарю клиентов."""
+        if not os.path.exists(path):
+            return 0
+        applied = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Недописанная строка после сбоя - дальше записей нет
+                    break
+                for change in entry.get('batch', [entry]):
+                    if 'client' in change:
+                        clients[change['name']] = change['client']
+                        self._see_ids([change['client']])
+                    else:
+                        clients.pop(change['name'], None)
+                applied += 1
+        return applied
+
+    def _remove_journals(self):
+        for path in (self.old_journal, JOURNAL_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def _change(client_name, client):
+        change = {'name': client_name}
+        if client is not None:
+            change['client'] = client
+        return change
+
+    def record(self, op, client_name, client):
+        """Дописывает в журнал одну запись об изменении клиента."""
+        self._see_ids([client])
+        self._append({'op': op, **self._change(client_name, client)})
+
+    def record_many(self, op, changes):
+        """Дописывает изменения нескольких клиентов одной строкой журнала."""
+        self._see_ids(client for _, client in changes)
+        self._append({'op': op, 'batch': [self._change(name, client) for name, client in changes]})
+
+    def _append(self, entry):
+        line = (json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        self._journal.write(line)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.journal_bytes = self._journal.tell()
+        metrics.inc('storage_bytes_written_total', len(line), file=JOURNAL_FILE)
+
+    def snapshot_due(self):
+        compacting = self._compactor is not None and self._compactor.is_alive()
+        return not compacting and (self.compact_pending or self.journal_bytes >= self.compact_bytes)
+
+    def write_snapshot(self, clients, groups=None):
+        """Откладывает текущий журнал и запускает запись снимка в фоне."""
+        if not self.snapshot_due():
+            return
+        self._journal.close()
+        if os.path.exists(self.old_journal):
+            # Прошлое сжатие не удалось: старый журнал еще не в снимке, и
+            # затирать его нельзя - текущий журнал дописывается в его конец
+            with open(JOURNAL_FILE, 'rb') as journal, open(self.old_journal, 'ab') as old_journal:
+                shutil.copyfileobj(journal, old_journal)
+                old_journal.flush()
+                os.fsync(old_journal.fileno())
+            os.remove(JOURNAL_FILE)
+        else:
+            os.replace(JOURNAL_FILE, self.old_journal)
+        self._open_journal()
+        self.compact_pending = True
+        self._see_ids(clients.values())
+        self._compactor = threading.Thread(target=self._compact, args=(clients, self.next_id), name='journal-compactor')
+        self._compactor.start()
+
+    def _compact(self, clients, next_id):
+        try:
+            with metrics.timer('storage', op='compact'):
+                atomic_write(DATA_FILE, dump_data(clients, next_id))
+            os.remove(self.old_journal)
+        except Exception as e:
+            # Старый журнал остается, compact_pending - тоже: снимок повторится
+            metrics.inc('storage_errors_total', op='compact')
+            print(f"❌ Ошибка сжатия журнала: {e}")
+        else:
+            self.compact_pending = False
+
+    def write_all(self, clients):
+        """Записывает новый снимок и очищает журнал."""
+        self._see_ids(clients.values())
+        atomic_write(DATA_FILE, dump_data(clients, self.next_id))
+        self._journal.truncate(0)
+        self.journal_bytes = 0
+        if os.path.exists(self.old_journal):
+            os.remove(self.old_journal)
+        self.compact_pending = False
+
+    def close(self):
+        """Дожидается сжатия и закрывает файл журнала."""
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+class SqliteStorage(Storage):
+    """Хранение в базе SQLite (режим WAL), одна строка на клиента.
+
+    Изменение клиента - это UPDATE одной строки, а не перезапись всех данных.
+    Индексы по sessions и last_payment_date ускоряют выборки из базы
+    сторонними средствами (отчеты самого бота строятся по данным в памяти).
+    next_id хранится строкой таблицы meta.
+    """
+
+    COLUMNS = ('id', 'sessions', 'last_payment_date', 'last_attendance', 'phone', 'notes', 'group_name')
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def connect(self):
+        """Открывает базу и создает таблицу с индексами, если их нет."""
+        if self.conn is None:
+            # Соединение открывается при запуске, а используется в потоке хранилища
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS clients (
+                    name TEXT PRIMARY KEY,
+                    id INTEGER,
+                    sessions INTEGER NOT NULL DEFAULT 0,
+                    last_payment_date TEXT,
+                    last_attendance TEXT,
+                    phone TEXT NOT NULL DEFAULT '',
+                    notes TEXT NOT NULL DEFAULT '',
+                    group_name TEXT NOT NULL DEFAULT ''
+                );
+                CREATE INDEX IF NOT EXISTS idx_clients_sessions ON clients(sessions);
+                CREATE INDEX IF NOT EXISTS idx_clients_last_payment ON clients(last_payment_date);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+            """)
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(clients)")}
+            if 'id' not in columns:
+                # База создана до появления id клиентов
+                self.conn.execute("ALTER TABLE clients ADD COLUMN id INTEGER")
+            if 'group_name' not in columns:
+                # База создана до появления групп
+                self.conn.execute("ALTER TABLE clients ADD COLUMN group_name TEXT NOT NULL DEFAULT ''")
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_id ON clients(id)")
+        return self.conn
+
+    def load(self):
+        """Читает всех клиентов из базы."""
+        conn = self.connect()
+        clients = {}
+        rows = conn.execute(f"SELECT name, {', '.join(self.COLUMNS)} FROM clients ORDER BY rowid")
+        for name, client_id, sessions, last_payment_date, last_attendance, phone, notes, group in rows:
+            client = {
+                'sessions': sessions,
+                'last_payment_date': last_payment_date,
+                'phone': phone,
+                'notes': notes
+            }
+            if last_attendance:
+                client['last_attendance'] = last_attendance
+            if client_id is not None:
+                client['id'] = client_id
+            if group:
+                client['group'] = group
+            clients[name] = client
+        row = conn.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+        saved_next_id = self.next_id = row[0] if row else 0
+        self._see_ids(clients.values())
+        if self.next_id != saved_next_id:
+            with conn:
+                self._save_next_id()
+        return clients
+
+    def _save_next_id(self):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)", (self.next_id,))
+
+    def _upsert(self, client_name, client):
+        self.conn.execute(
+            f"INSERT INTO clients (name, {', '.join(self.COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET "
+            + ", ".join(f"{column} = excluded.{column}" for column in self.COLUMNS),
+            (client_name, client.get('id'), client['sessions'], client['last_payment_date'],
+             client.get('last_attendance'), client.get('phone', ''), client.get('notes', ''), client.get('group', ''))
+        )
+
+    def record(self, op, client_name, client):
+        """Обновляет или удаляет строку одного клиента."""
+        self.record_many(op, [(client_name, client)])
+
+    def record_many(self, op, changes):
+        """Обновляет строки нескольких клиентов одной транзакцией."""
+        conn = self.connect()
+        next_id = self.next_id
+        self._see_ids(client for _, client in changes)
+        with conn:
+            for client_name, client in changes:
+                if client is None:
+                    conn.execute("DELETE FROM clients WHERE name = ?", (client_name,))
+                else:
+                    self._upsert(client_name, client)
+            if self.next_id != next_id:
+                self._save_next_id()
+        # Сколько байт SQLite записал на диск, не узнать, поэтому считаем строки
+        metrics.inc('storage_rows_written_total', len(changes), file=os.path.basename(self.path))
+
+    def write_all(self, clients):
+        """Записывает всех клиентов одной транзакцией."""
+        conn = self.connect()
+        self._see_ids(clients.values())
+        with conn:
+            for client_name, client in clients.items():
+                self._upsert(client_name, client)
+            self._save_next_id()
+        metrics.inc('storage_rows_written_total', len(clients), file=os.path.basename(self.path))
+
+    def close(self):
+        """Закрывает соединение с базой."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+def migrate_json_to_sqlite(json_path=DATA_FILE, db_path=SQLITE_FILE):
+    """Импортирует клиентов из JSON-файла в базу SQLite."""
+    version, clients, next_id = read_data_file(json_path)
+    clients = upgrade_data(version, clients)
+    storage = SqliteStorage(db_path)
+    storage.next_id = max(next_id, 1)
+    try:
+        storage.write_all(clients)
+    finally:
+        storage.close()
+    print(f"✅ Перенесено клиентов из {json_path} в {db_path}: {len(clients)}")
+    return len(clients)
+
+class ShardedStorage(Storage):
+    """Клиенты по группам: у каждой группы свой JSON-файл в каталоге directory.
+
+    ClientStore отмечает группы изменяемых клиентов (при переводе в другую
+    группу - обе) и через save_delay секунд копирует и передает сюда только
+    клиентов этих групп, так что объем копирования и записи растет с
+    размером группы, а не всей базы. При первом запуске клиенты из
+    DATA_FILE раскладываются по файлам групп. next_id хранится в отдельном
+    файле каталога и перезаписывается, только когда вырос.
+    """
+
+    by_groups = True
+
+    def __init__(self, directory, save_delay):
+        self.directory = directory
+        self.snapshot_delay = save_delay
+        self._saved_next_id = 0
+
+    def next_id_path(self, directory=None):
+        return os.path.join(directory or self.directory, 'next_id')
+
+    def shard_path(self, group, directory=None):
+        """Файл группы; символы, недопустимые в именах файлов, кодируются как %XX."""
+        name = ''.join(char if char.isalnum() or char in ' -' else f'%{ord(char):02X}' for char in group)
+        return os.path.join(directory or self.directory, (name or '_') + '.json')
+
+    def load(self):
+        """Читает файлы всех групп; при первом запуске делит DATA_FILE по группам."""
+        if not os.path.isdir(self.directory):
+            version, clients, self.next_id = read_data_file(DATA_FILE)
+            clients = upgrade_data(version, clients)
+            self._see_ids(clients.values())
+            # Файлы пишутся во временный каталог, чтобы сбой не оставил часть групп
+            tmp_directory = self.directory + '.tmp'
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            os.makedirs(tmp_directory)
+            self._write_groups(clients, tmp_directory)
+            self._save_next_id(tmp_directory)
+            os.replace(tmp_directory, self.directory)
+            print(f"✅ Клиенты из {DATA_FILE} разложены по группам в {self.directory}")
+            return clients
+        self.next_id = self._saved_next_id = 0
+        if os.path.exists(self.next_id_path()):
+            with open(self.next_id_path(), 'r', encoding='utf-8') as f:
+                self.next_id = self._saved_next_id = int(f.read().strip() or 0)
+        clients = {}
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, filename)
+            version, shard, _ = read_data_file(path)
+            if version != SCHEMA_VERSION:
+                shard = upgrade_data(version, shard)
+                atomic_write(path, dump_data(shard))
+            clients.update(shard)
+        self._see_ids(clients.values())
+        return clients
+
+    def record(self, op, client_name, client):
+        # Файлы пишутся снимком, но id нового клиента нужно учесть сразу:
+        # клиента могут удалить раньше, чем его группа попадет в снимок
+        self._see_ids([client])
+
+    def _save_next_id(self, directory=None):
+        if self.next_id != self._saved_next_id:
+            atomic_write(self.next_id_path(directory), str(self.next_id))
+            self._saved_next_id = self.next_id
+
+    def write_snapshot(self, clients, groups=None):
+        """Перезаписывает файлы групп groups клиентами из clients."""
+        self._see_ids(clients.values())
+        self._save_next_id()
+        if groups is None:
+            self._write_groups(clients)
+            return
+        shards = {group: {} for group in groups}
+        for client_name, client in clients.items():
+            shard = shards.get(client.get('group', ''))
+            if shard is not None:
+                shard[client_name] = client
+        for group, shard in shards.items():
+            self._write_shard(group, shard)
+
+    def _write_shard(self, group, clients, directory=None):
+        path = self.shard_path(group, directory)
+        if clients:
+            atomic_write(path, dump_data(clients))
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _write_groups(self, clients, directory=None):
+        """Записывает файлы всех групп и удаляет файлы групп, в которых никого не осталось."""
+        shards = defaultdict(dict)
+        for client_name, client in clients.items():
+            shards[client.get('group', '')][client_name] = client
+        for group, shard in shards.items():
+            self._write_shard(group, shard, directory)
+        written = {os.path.basename(self.shard_path(group)) for group in shards}
+        directory = directory or self.directory
+        for filename in os.listdir(directory):
+            if filename.endswith('.json') and filename not in written:
+                os.remove(os.path.join(directory, filename))
+
+    def write_all(self, clients):
+        self._see_ids(clients.values())
+        self._save_next_id()
+        self._write_groups(clients)
+
+class ClientHistory:
+    """История оплат и посещений клиентов в виде рядов времени.
+
+    Для каждого клиента и вида события хранится отсортированный массив
+    array('I') с моментами событий в секундах epoch - 4 байта на событие.
+    Выборки за период делаются бисекцией по массиву одного клиента, не
+    затрагивая остальных. На диске история лежит в отдельном файле из
+    записей фиксированной длины (id клиента, вид события, время), которые
+    только дописываются в конец.
+
+    Файл пишется сразу, а не снимком, поэтому запись CREATE о новом клиенте
+    сохраняет его id и тогда, когда сам клиент до снимка хранилища не дожил:
+    max_id после read() не дает выдать этот id (и его события) другому.
+    """
+
+    ATTEND, PAYMENT, FORGET, CREATE = 0, 1, 2, 3
+    RECORD = struct.Struct('<IBI')
+
+    def __init__(self, path):
+        self.path = path
+        self.series = {self.ATTEND: {}, self.PAYMENT: {}}  # вид -> {id клиента: array('I')}
+        self.pending = []  # Записи, еще не отданные на диск
+        self.max_id = 0  # Наибольший id клиента в файле
+        self._file = None
+
+    def seed(self, clients):
+        """Заполняет пустую историю последними датами оплаты и посещения клиентов."""
+        for client in clients.values():
+            if client.paid_at:
+                self.add(client.id, self.PAYMENT, client.paid_at)
+            if client.attended_at:
+                self.add(client.id, self.ATTEND, client.attended_at)
+        self.write(self.take_pending())
+
+    def read(self):
+        """Читает историю из файла; False, если файла еще нет."""
+        self.series = {self.ATTEND: {}, self.PAYMENT: {}}
+        self.pending = []
+        self.max_id = 0
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'rb') as f:
+            raw = f.read()
+        usable = len(raw) - len(raw) % self.RECORD.size
+        if usable != len(raw):
+            # Обрезанная при сбое последняя запись
+            with open(self.path, 'r+b') as f:
+                f.truncate(usable)
+        for client_id, kind, moment in self.RECORD.iter_unpack(memoryview(raw)[:usable]):
+            if client_id > self.max_id:
+                self.max_id = client_id
+            if kind == self.FORGET:
+                for series in self.series.values():
+                    series.pop(client_id, None)
+            elif kind in self.series:
+                self._insert(client_id, kind, moment)
+        return True
+
+    def _insert(self, client_id, kind, moment):
+        events = self.series[kind].get(client_id)
+        if events is None:
+            events = self.series[kind][client_id] = array('I')
+        if not events or events[-1] <= moment:
+            events.append(moment)
+        else:
+            # Часы перевели назад - сохраняем порядок
+            events.insert(bisect.bisect_right(events, moment), moment)
+
+    def add(self, client_id, kind, moment):
+        """Добавляет событие клиенту; на диск оно попадет со следующим write()."""
+        self._insert(client_id, kind, moment)
+        self.pending.append(self.RECORD.pack(client_id, kind, moment))
+
+    def created(self, client_id, moment):
+        """Отмечает появление клиента; на диск запись попадет со следующим write()."""
+        self.pending.append(self.RECORD.pack(client_id, self.CREATE, moment))
+
+    def forget(self, client_id):
+        """Удаляет историю клиента (при удалении клиента)."""
+        for series in self.series.values():
+            series.pop(client_id, None)
+        self.pending.append(self.RECORD.pack(client_id, self.FORGET, 0))
+
+    def take_pending(self):
+        """Забирает накопленные записи для write()."""
+        chunk = b''.join(self.pending)
+        self.pending = []
+        return chunk
+
+    def write(self, chunk):
+        """Дописывает записи в файл истории (в потоке хранилища)."""
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        self._file.write(chunk)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        metrics.inc('storage_bytes_written_total', len(chunk), file=os.path.basename(self.path))
+
+    def events(self, client_id, kind, start_ts=0, end_ts=None):
+        """Моменты событий клиента за период [start_ts, end_ts)."""
+        events = self.series[kind].get(client_id)
+        if not events:
+            return array('I')
+        low = bisect.bisect_left(events, start_ts)
+        high = len(events) if end_ts is None else bisect.bisect_left(events, end_ts)
+        return events[low:high]
+
+    def count(self, client_id, kind, start_ts=0, end_ts=None):
+        """Количество событий клиента за период [start_ts, end_ts)."""
+        events = self.series[kind].get(client_id)
+        if not events:
+            return 0
+        low = bisect.bisect_left(events, start_ts)
+        high = len(events) if end_ts is None else bisect.bisect_left(events, end_ts)
+        return high - low
+
+    def last(self, client_id, kind):
+        """Время последнего события клиента или 0, если событий не было."""
+        events = self.series[kind].get(client_id)
+        return events[-1] if events else 0
+
+    def weekday_counts(self, client_id, start_ts=0, end_ts=None):
+        """Посещения клиента по дням недели, понедельник - первый."""
+        counts = [0] * 7
+        for moment in self.events(client_id, self.ATTEND, start_ts, end_ts):
+            counts[datetime.fromtimestamp(moment).weekday()] += 1
+        return counts
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class NameIndex:
+    """Поисковый индекс по именам клиентов.
+
+    Имена приводятся к нижнему регистру, ё заменяется на е. Каждое слово
+    имени лежит в префиксном дереве (узел - словарь буква -> узел, под
+    ключом '' - id клиентов, у которых слово здесь заканчивается), так что
+    "ива" находит и "Иванову Марию", и "Петра Иванова". Для опечаток есть
+    индекс триграмм: триграмма -> множество id. Кандидатов дают самые
+    редкие триграммы запроса, остальные только проверяются по множествам,
+    поэтому частые сочетания вроде "ова" не заставляют перебирать всех.
+    Индекс обновляется при добавлении и удалении клиента.
+    """
+
+    MIN_SIMILARITY = 0.5  # Доля триграмм запроса, которая должна совпасть
+    FUZZY_MIN_LETTERS = 4  # В более коротких запросах опечатки не ищем - подошло бы полсписка
+
+    def __init__(self, clients=()):
+        self.trie = {}
+        self.trigrams = defaultdict(set)
+        for client_id, client_name in clients:
+            self.add(client_id, client_name)
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(text.lower().replace('ё', 'е').split())
+
+    @classmethod
+    def words(cls, text):
+        """Различные слова текста после нормализации."""
+        return list(dict.fromkeys(cls.normalize(text).split()))
+
+    @staticmethod
+    def grams(words):
+        """Триграммы слов; слова дополняются пробелами, чтобы учитывались их начало и конец."""
+        result = set()
+        for word in words:
+            padded = f" {word} "
+            result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        return result
+
+    def add(self, client_id, client_name):
+        words = self.words(client_name)
+        for word in words:
+            node = self.trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node.setdefault('', set()).add(client_id)
+        for gram in self.grams(words):
+            self.trigrams[gram].add(client_id)
+
+    def remove(self, client_id, client_name):
+        words = self.words(client_name)
+        for word in words:
+            path = [self.trie]
+            for char in word:
+                path.append(path[-1][char])
+            path[-1][''].discard(client_id)
+            if not path[-1]['']:
+                del path[-1]['']
+            # Удаляем опустевшие узлы снизу вверх
+            for depth in range(len(word), 0, -1):
+                if path[depth]:
+                    break
+                del path[depth - 1][word[depth - 1]]
+        for gram in self.grams(words):
+            ids = self.trigrams[gram]
+            ids.discard(client_id)
+            if not ids:
+                del self.trigrams[gram]
+
+    def _with_prefix(self, prefix):
+        """id клиентов, у которых есть слово с началом prefix, в алфавитном порядке слов."""
+        node = self.trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield from node.get('', ())
+            stack.extend(child for char, child in sorted(node.items(), reverse=True) if char)
+
+    def _similar(self, words):
+        """id клиентов, похожих на запрос по триграммам, от самых похожих."""
+        query = self.grams(words)
+        needed = max(1, math.ceil(len(query) * self.MIN_SIMILARITY))
+        postings = sorted((self.trigrams.get(gram, ()) for gram in query), key=len)
+        # Клиент, совпавший хотя бы в needed триграммах, обязательно есть
+        # в одном из len(query) - needed + 1 самых редких множеств
+        split = len(query) - needed + 1
+        counts = defaultdict(int)
+        for ids in postings[:split]:
+            for client_id in ids:
+                counts[client_id] += 1
+        scored = []
+        for client_id, count in counts.items():
+            count += sum(client_id in ids for ids in postings[split:])
+            if count >= needed:
+                scored.append((-count, client_id))
+        scored.sort()
+        return [client_id for _, client_id in scored]
+
+    def search(self, text, limit, name_of):
+        """Лучшие совпадения с запросом: сначала по началу слов, затем похожие.
+
+        name_of(id) возвращает имя клиента - по нему проверяются остальные
+        слова запроса.
+        """
+        words = self.words(text)
+        if not words:
+            return []
+        first, *rest = sorted(words, key=len, reverse=True)
+        found = {}
+        for client_id in self._with_prefix(first):
+            if client_id in found:
+                continue
+            if rest:
+                name_words = self.words(name_of(client_id))
+                if not all(any(word.startswith(part) for word in name_words) for part in rest):
+                    continue
+            found[client_id] = None
+            if len(found) == limit:
+                return list(found)
+        if sum(map(len, words)) < self.FUZZY_MIN_LETTERS:
+            return list(found)
+        for client_id in self._similar(words):
+            found[client_id] = None
+            if len(found) == limit:
+                break
+        return list(found)
+
+class ClientStore:
+    """Хранит клиентов в памяти, запись на диск выполняет storage.
+
+    Данные читаются один раз при запуске, все чтения обслуживаются из памяти.
+    Обращения к storage идут через пул из одного потока, чтобы дисковый
+    ввод-вывод и сериализация не останавливали цикл событий, а изменения
+    попадали на диск в том же порядке, в каком сделаны. Изменения одного
+    клиента выполняются под его блокировкой lock().
+    """
+
+    def __init__(self, storage, history):
+        self.storage = storage
+        self.history = history
+        self.clients = None
+        self.version = 0  # Растет при каждом изменении клиентов
+        self.revisions = {}  # имя -> версия данных при последнем изменении клиента
+        self.loaded_version = 0
+        self.sorted_names = []
+        self.by_id = {}  # id клиента -> имя
+        self.next_id = 1
+        self._names = None  # Поисковый индекс имен, строится при первом поиске
+        self.by_sessions = defaultdict(dict)  # остаток занятий -> {имя: None}
+        self.by_group = defaultdict(dict)  # группа -> {имя: None}
+        self.changed_groups = set()  # Группы с изменениями, еще не переданными в снимок
+        self.total_sessions = 0
+        self.month = None  # Месяц счетчиков пополнений и посещений, 'ГГГГ-ММ'
+        self.month_topups = 0
+        self.month_attendances = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+        self._locks = {}
+        self._snapshot_handle = None
+        self._snapshot_task = None
+
+    @property
+    def data(self):
+        """Словарь клиентов; при первом обращении загружается из хранилища."""
+        if self.clients is None:
+            self.load()
+        return self.clients
+
+    def load(self):
+        """Загружает данные из хранилища в память (при запуске, до цикла событий)."""
+        clients = self._timed('load', self.storage.load)
+        with metrics.timer('storage', op='load_records'):
+            self.clients = {sys.intern(name): Client.from_dict(data) for name, data in clients.items()}
+        self.sorted_names = sorted(self.clients)
+        # История читается до выдачи id: в ней могут быть id клиентов, не попавших в снимок
+        history_found = self._timed('history_load', self.history.read)
+        self._assign_ids()
+        if not history_found:
+            self.history.seed(self.clients)
+        self._names = None
+        self.version += 1
+        self.revisions = {}
+        self.loaded_version = self.version
+        self.by_sessions = defaultdict(dict)
+        self.by_group = defaultdict(dict)
+        self.changed_groups = set()
+        self.total_sessions = 0
+        self.month = None
+        self._roll_month()
+        month_start = self._month_start()
+        for client_name, client in self.clients.items():
+            self.by_sessions[client.sessions][client_name] = None
+            self.by_group[client.group][client_name] = None
+            self.total_sessions += client.sessions
+            self.month_topups += self.history.count(client.id, ClientHistory.PAYMENT, month_start)
+            self.month_attendances += self.history.count(client.id, ClientHistory.ATTEND, month_start)
+
+    def _assign_ids(self):
+        """Строит карту id и выдает id клиентам, у которых его еще нет.
+
+        Новые id продолжают next_id хранилища и id из истории, поэтому id
+        удаленных клиентов (и старые кнопки с ними) никогда не достаются новым
+        клиентам - даже если удаленный клиент не успел попасть в снимок.
+        """
+        self.by_id = {client.id: name for name, client in self.clients.items() if client.id is not None}
+        self.next_id = max(max(self.by_id, default=0), self.history.max_id) + 1
+        self.next_id = max(self.next_id, self.storage.next_id)
+        missing = [name for name, client in self.clients.items() if client.id is None]
+        for client_name in missing:
+            self._give_id(client_name, self.clients[client_name])
+        if missing:
+            self._timed('write_all', self.storage.write_all, self.snapshot())
+            print(f"✅ Клиентам выданы id: {len(missing)}")
+
+    def _give_id(self, client_name, client):
+        client.id = self.next_id
+        self.by_id[self.next_id] = client_name
+        self.next_id += 1
+
+    def name_of(self, client_id):
+        """Имя клиента по id или None, если такого клиента нет."""
+        return self.by_id.get(client_id)
+
+    def id_of(self, client_name):
+        """id клиента по имени."""
+        return self.data[client_name].id
+
+    def insert(self, client_name, client):
+        """Добавляет нового клиента (Client), выдает ему id и обновляет индексы."""
+        client_name = sys.intern(client_name)
+        self._give_id(client_name, client)
+        self.data[client_name] = client
+        self._touch(client_name)
+        bisect.insort(self.sorted_names, client_name)
+        if self._names is not None:
+            self._names.add(client.id, client_name)
+        self.by_sessions[client.sessions][client_name] = None
+        self.by_group[client.group][client_name] = None
+        self.total_sessions += client.sessions
+        self.history.created(client.id, int(time.time()))
+        if client.paid_at:
+            self.history.add(client.id, ClientHistory.PAYMENT, client.paid_at)
+
+    def remove(self, client_name):
+        """Удаляет клиента и обновляет индексы."""
+        client = self.data.pop(client_name)
+        self.version += 1
+        self.revisions.pop(client_name, None)
+        self.changed_groups.add(client.group)
+        del self.by_id[client.id]
+        index = bisect.bisect_left(self.sorted_names, client_name)
+        del self.sorted_names[index]
+        if self._names is not None:
+            self._names.remove(client.id, client_name)
+        self._unbucket(self.by_sessions, client.sessions, client_name)
+        self._unbucket(self.by_group, client.group, client_name)
+        self.total_sessions -= client.sessions
+        # История клиента удаляется, и счетчики месяца, которые при загрузке
+        # считаются по истории, должны забыть его события уже сейчас
+        self._roll_month()
+        month_start = self._month_start()
+        self.month_topups -= self.history.count(client.id, ClientHistory.PAYMENT, month_start)
+        self.month_attendances -= self.history.count(client.id, ClientHistory.ATTEND, month_start)
+        self.history.forget(client.id)
+
+    def set_sessions(self, client_name, sessions):
+        """Меняет остаток занятий клиента и переносит его в другую корзину индекса."""
+        client = self.data[client_name]
+        self._touch(client_name)
+        self._unbucket(self.by_sessions, client.sessions, client_name)
+        self.total_sessions += sessions - client.sessions
+        client.sessions = sessions
+        self.by_sessions[sessions][client_name] = None
+
+    def set_payment_date(self, client_name, moment):
+        """Запоминает дату оплаты клиента."""
+        client = self.data[client_name]
+        self._touch(client_name)
+        client.paid_at = int(moment.timestamp())
+        self.history.add(client.id, ClientHistory.PAYMENT, client.paid_at)
+
+    def set_attendance_date(self, client_name, moment):
+        """Запоминает дату посещения клиента."""
+        client = self.data[client_name]
+        self._touch(client_name)
+        client.attended_at = int(moment.timestamp())
+        self.history.add(client.id, ClientHistory.ATTEND, client.attended_at)
+
+    def _touch(self, client_name):
+        """Отмечает изменение клиента: растут версия данных и ревизия клиента, группа ждет снимка."""
+        self.version += 1
+        self.revisions[client_name] = self.version
+        self.changed_groups.add(self.clients[client_name].group)
+
+    def revision(self, client_name):
+        """Ревизия клиента: меняется при каждом изменении его данных."""
+        return self.revisions.get(client_name, self.loaded_version)
+
+    def set_group(self, client_name, group):
+        """Переводит клиента в группу ('' - без группы)."""
+        client = self.data[client_name]
+        self._touch(client_name)
+        self._unbucket(self.by_group, client.group, client_name)
+        client.group = sys.intern(group) if group else ''
+        self.by_group[client.group][client_name] = None
+        self.changed_groups.add(client.group)
+
+    @staticmethod
+    def _unbucket(index, key, client_name):
+        bucket = index[key]
+        del bucket[client_name]
+        if not bucket:
+            del index[key]
+
+    def groups(self):
+        """Названия групп, в которых есть клиенты, по алфавиту (без пустой группы)."""
+        return sorted(group for group in self.by_group if group)
+
+    def group_members(self, group):
+        """Имена клиентов группы."""
+        return list(self.by_group.get(group, ()))
+
+    def clients_with_sessions(self, sessions, group=None):
+        """Имена клиентов (всех или группы), у которых осталось ровно sessions занятий."""
+        if group is not None:
+            return [client_name for client_name in self.by_group.get(group, ())
+                    if self.clients[client_name].sessions == sessions]
+        bucket = self.by_sessions.get(sessions)
+        return list(bucket) if bucket else []
+
+    def _roll_month(self):
+        """Обнуляет счетчики месяца, если месяц сменился."""
+        month = datetime.now().strftime('%Y-%m')
+        if month != self.month:
+            self.month = month
+            self.month_topups = 0
+            self.month_attendances = 0
+
+    def _month_start(self):
+        """Начало месяца счетчиков в секундах epoch."""
+        return int(datetime.strptime(self.month, '%Y-%m').timestamp())
+
+    def count_event(self, op):
+        """Учитывает пополнение (topup) или посещение (attend) в счетчиках месяца."""
+        self._roll_month()
+        if op == 'topup':
+            self.month_topups += 1
+        elif op == 'attend':
+            self.month_attendances += 1
+
+    def stats(self, group=None):
+        """Сводные показатели.
+
+        По всей базе они поддерживаются при каждом изменении и не требуют
+        перебора; по группе считаются перебором только ее клиентов.
+        """
+        self._roll_month()
+        if group is not None:
+            return self._group_stats(group)
+        return {
+            'clients': len(self.data),
+            'sessions': self.total_sessions,
+            'at_threshold': len(self.by_sessions.get(REMINDER_THRESHOLD, ())),
+            'at_zero': len(self.by_sessions.get(0, ())),
+            'month_topups': self.month_topups,
+            'month_attendances': self.month_attendances,
+        }
+
+    @property
+    def names(self):
+        """Поисковый индекс имен; строится при первом обращении и дальше обновляется."""
+        if self._names is None:
+            with metrics.timer('storage', op='search_index'):
+                self._names = NameIndex(self.by_id.items())
+        return self._names
+
+    def search(self, text, limit):
+        """Имена клиентов, лучше всего подходящих под поисковый запрос."""
+        return [self.by_id[client_id] for client_id in self.names.search(text, limit, self.by_id.get)]
+
+    def _group_stats(self, group):
+        month_start = self._month_start()
+        clients = [self.clients[client_name] for client_name in self.by_group.get(group, ())]
+        return {
+            'clients': len(clients),
+            'sessions': sum(client.sessions for client in clients),
+            'at_threshold': sum(client.sessions == REMINDER_THRESHOLD for client in clients),
+            'at_zero': sum(client.sessions == 0 for client in clients),
+            'month_topups': sum(self.history.count(client.id, ClientHistory.PAYMENT, month_start)
+                                for client in clients),
+            'month_attendances': sum(self.history.count(client.id, ClientHistory.ATTEND, month_start)
+                                     for client in clients),
+        }
+
+    def page_count(self, page_size):
+        """Количество страниц списка клиентов."""
+        return max(1, -(-len(self.sorted_names) // page_size))
+
+    def page(self, page, page_size):
+        """Имена клиентов на странице page (нумерация с нуля) в алфавитном порядке."""
+        start = page * page_size
+        return self.sorted_names[start:start + page_size]
+
+    def page_of(self, client_name, page_size):
+        """Номер страницы списка, на которой находится клиент."""
+        return bisect.bisect_left(self.sorted_names, client_name) // page_size
+
+    def lock(self, client_name):
+        """Блокировка, под которой выполняются изменения одного клиента."""
+        lock = self._locks.get(client_name)
+        if lock is None:
+            lock = self._locks[client_name] = asyncio.Lock()
+        return lock
+
+    async def run_io(self, func, *args):
+        """Выполняет вызов хранилища в потоке хранилища."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
 
-def mark_attendance(client_name):
+    async def record(self, op, client_name):
+        """Сохраняет изменение клиента (topup, attend, delete)."""
+        client = self.clients.get(client_name)
+        if client is not None:
+            client = client.to_dict()
+        await self.run_io(self._persist, self.history.take_pending(), self.storage.record, op, client_name, client)
+        self._schedule_snapshot()
+
+    async def record_many(self, op, client_names):
+        """Сохраняет изменения нескольких клиентов одной записью в хранилище."""
+        changes = []
+        for client_name in client_names:
+            client = self.clients.get(client_name)
+            changes.append((client_name, client.to_dict() if client is not None else None))
+        await self.run_io(self._persist, self.history.take_pending(), self.storage.record_many, op, changes)
+        self._schedule_snapshot()
+
+    def _persist(self, events, write, *args):
+        # Клиент и его история пишутся одной задачей потока хранилища
+        self._timed(write.__name__, write, *args)
+        if events:
+            self._timed('history', self.history.write, events)
+
+    @staticmethod
+    def _timed(op, func, *args):
+        """Вызывает операцию хранилища и учитывает ее время в метриках."""
+        with metrics.timer('storage', op=op):
+            return func(*args)
+
+    def _schedule_snapshot(self):
+        """Планирует снимок, если он нужен хранилищу и еще не запланирован."""
+        if self._snapshot_handle is not None or self._snapshot_task is not None:
+            return
+        if not self._snapshot_due():
+            return
+        loop = asyncio.get_running_loop()
+        self._snapshot_handle = loop.call_later(self.storage.snapshot_delay, self._start_snapshot)
+
+    def _snapshot_due(self):
+        if self.storage.by_groups:
+            return bool(self.changed_groups)
+        return self.storage.snapshot_due()
+
+    def _start_snapshot(self):
+        self._snapshot_handle = None
+        self._snapshot_task = asyncio.ensure_future(self._write_snapshot())
+
+    async def _write_snapshot(self):
+        # Копию снимаем в цикле событий: в потоке хранилища словарь мог бы
+        # меняться прямо во время сериализации. Снимаются только кортежи полей,
+        # перевод дат в ISO и сборка словарей идут уже в потоке хранилища
+        with metrics.timer('storage', op='snapshot_copy'):
+            groups, states = self._snapshot_states()
+        try:
+            await self.run_io(self._write_states, groups, states)
+        except Exception as e:
+            if groups:
+                self.changed_groups |= groups  # Эти группы запишутся следующим снимком
+            print(f"❌ Ошибка записи данных: {e}")
+        finally:
+            self._snapshot_task = None
+        self._schedule_snapshot()
+
+    def snapshot(self):
+        """Все клиенты словарями формата clients_cheer4.json."""
+        return {client_name: client.to_dict() for client_name, client in self.clients.items()}
+
+    def _snapshot_states(self):
+        """Группы снимка (None - все клиенты) и копии полей клиентов, которые нужны хранилищу."""
+        # Группы берутся из памяти, а не из уже записанных изменений: клиент,
+        # переведенный в другую группу, попадает в снимок вместе с обеими
+        groups, self.changed_groups = self.changed_groups, set()
+        if self.storage.by_groups:
+            client_names = itertools.chain.from_iterable(self.by_group.get(group, ()) for group in groups)
+        else:
+            groups = None
+            client_names = self.clients
+        return groups, {client_name: self.clients[client_name].state() for client_name in client_names}
+
+    def _write_states(self, groups, states):
+        snapshot = {client_name: Client.state_to_dict(state) for client_name, state in states.items()}
+        self._timed('write_snapshot', self.storage.write_snapshot, snapshot, groups)
+
+    async def flush(self):
+        """Дожидается, пока все изменения попадут на диск."""
+        await self.run_io(lambda: None)  # Дожидаемся записей, уже стоящих в очереди
+        self._schedule_snapshot()
+        if self._snapshot_handle is not None:
+            self._snapshot_handle.cancel()
+            self._start_snapshot()
+        if self._snapshot_task is not None:
+            await self._snapshot_task
+
+    def close(self):
+        """Дописывает отложенное и закрывает хранилище (после остановки цикла событий)."""
+        if self._snapshot_handle is not None:
+            self._snapshot_handle.cancel()
+            self._snapshot_handle = None
+        self._executor.shutdown(wait=True)
+        if self.clients is not None and self._snapshot_due():
+            self._write_states(*self._snapshot_states())
+        self.storage.close()
+        self.history.close()
+
+def create_storage():
+    """Создает хранилище согласно STORAGE_MODE."""
+    if STORAGE_MODE == 'journal':
+        return JournalStorage(JOURNAL_COMPACT_BYTES)
+    if STORAGE_MODE == 'sqlite':
+        return SqliteStorage(SQLITE_FILE)
+    if STORAGE_MODE == 'sharded':
+        return ShardedStorage(SHARDS_DIR, SAVE_DELAY)
+    return JsonFileStorage(SAVE_DELAY)
+
+store = ClientStore(create_storage(), ClientHistory(HISTORY_FILE))
+
+def load_data():
+    """Возвращает данные о клиентах из памяти."""
+    return store.data
+
+async def add_sessions_to_client(client_name, sessions_to_add, phone="", notes=""):
+    """Добавляет занятия абонемента клиенту.
+
+    Оплатой (датой оплаты, событием истории и пополнением в счетчике месяца)
+    считается только добавление хотя бы одного занятия: клиент, созданный
+    без занятий, оплат не имеет.
+    """
+    paid = sessions_to_add > 0
+    async with store.lock(client_name):
+        data = load_data()
+        if client_name in data:
+            store.set_sessions(client_name, data[client_name].sessions + sessions_to_add)
+            if paid:
+                store.set_payment_date(client_name, datetime.now())
+            if phone:
+                data[client_name].phone = phone
+            if notes:
+                data[client_name].notes = notes
+        else:
+            store.insert(client_name, Client(sessions_to_add, int(time.time()) if paid else 0, phone=phone, notes=notes))
+        if paid:
+            store.count_event('topup')
+        await store.record('topup', client_name)
+
+async def mark_attendance(client_name):
     """Отмечает посещение и возвращает остаток занятий."""
-    data = load_data()
-    if client_name in data and data[client_name]['sessions'] > 0:
-        data[client_name]['sessions'] -= 1
-        data[client_name]['last_attendance'] = datetime.now().isoformat()
-        save_data(data)
-        return data[client_name]['sessions']
-    else:
-        return None
+    async with store.lock(client_name):
+        data = load_data()
+        if client_name in data and data[client_name].sessions > 0:
+            store.set_sessions(client_name, data[client_name].sessions - 1)
+            store.set_attendance_date(client_name, datetime.now())
+            store.count_event('attend')
+            await store.record('attend', client_name)
+            return data[client_name].sessions
+        else:
+            return None
+
+async def mark_group_attendance(client_names):
+    """Отмечает посещение сразу нескольким клиентам.
+
+    Все остатки уменьшаются вместе и сохраняются одной записью в хранилище.
+    Возвращает (отмеченные [(имя, остаток)], пропущенные [имя]) - пропускаются
+    клиенты без занятий и удаленные.
+    """
+    client_names = list(dict.fromkeys(client_names))
+    async with contextlib.AsyncExitStack() as stack:
+        # Блокировки берутся в одном порядке, чтобы две групповые отметки не ждали друг друга
+        for client_name in sorted(client_names):
+            await stack.enter_async_context(store.lock(client_name))
+        data = load_data()
+        now = datetime.now()
+        marked, skipped = [], []
+        for client_name in client_names:
+            client = data.get(client_name)
+            if client is None or client.sessions <= 0:
+                skipped.append(client_name)
+                continue
+            store.set_sessions(client_name, client.sessions - 1)
+            store.set_attendance_date(client_name, now)
+            store.count_event('attend')
+            marked.append((client_name, client.sessions))
+        if marked:
+            await store.record_many('attend', [client_name for client_name, _ in marked])
+    return marked, skipped
 
 def get_remaining_sessions(client_name):
     """Возвращает количество оставшихся занятий."""
     data = load_data()
     if client_name in data:
-        return data[client_name]['sessions']
+        return data[client_name].sessions
     return None
 
 def get_client_info(client_name):
@@ -123,411 +1645,1461 @@ def get_client_info(client_name):
     data = load_data()
     return data.get(client_name)
 
-def delete_client(client_name):
-    """Удаляет клиента из базы данных."""
-    data = load_data()
-    if client_name in data:
-        del data[client_name]
-        save_data(data)
+async def set_client_group(client_name, group):
+    """Переводит клиента в группу; возвращает False, если клиента нет."""
+    async with store.lock(client_name):
+        if client_name not in load_data():
+            return False
+        store.set_group(client_name, group)
+        await store.record('group', client_name)
         return True
-    return False
+
+async def delete_client(client_name):
+    """Удаляет клиента из базы данных."""
+    async with store.lock(client_name):
+        data = load_data()
+        if client_name in data:
+            store.remove(client_name)
+            await store.record('delete', client_name)
+            return True
+        return False
+
+class CheckinGroups:
+    """Сохраненные группы для групповой отметки: название и id клиентов.
+
+    Хранятся в CHECKIN_GROUPS_FILE отдельно от клиентов. id удаленных
+    клиентов из групп не вычищаются, а пропускаются при использовании.
+    Группы клиентов (Client.group) здесь не хранятся: они предлагаются для
+    отметки рядом с сохраненными и всегда берут текущий состав из store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.groups = {}  # id группы -> {'name': ..., 'clients': [id клиента, ...]}
+        self.next_id = 1
+        self._save_lock = asyncio.Lock()
+
+    def load(self):
+        """Читает группы из файла."""
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                try:
+                    groups = json.load(f)
+                except json.JSONDecodeError:
+                    groups = {}
+            self.groups = {int(group_id): group for group_id, group in groups.items()}
+        self.next_id = max(self.groups, default=0) + 1
+
+    async def save(self):
+        """Записывает группы в файл, не задерживая цикл событий.
+
+        Записи идут по одной: одновременные atomic_write через общий .tmp
+        мешали бы друг другу. Текст снимается уже под блокировкой, поэтому
+        последней на диск попадает последняя версия групп.
+        """
+        async with self._save_lock:
+            text = json.dumps(self.groups, ensure_ascii=False, indent=4)
+            await asyncio.to_thread(atomic_write, self.path, text)
+
+    async def add(self, name, client_ids):
+        """Сохраняет новую группу и возвращает ее id."""
+        group_id = self.next_id
+        self.next_id += 1
+        self.groups[group_id] = {'name': name, 'clients': sorted(client_ids)}
+        await self.save()
+        return group_id
+
+    async def remove(self, group_id):
+        """Удаляет группу."""
+        if self.groups.pop(group_id, None) is not None:
+            await self.save()
+
+    def client_names(self, group_id):
+        """Имена существующих клиентов группы."""
+        names = (store.name_of(client_id) for client_id in self.groups[group_id]['clients'])
+        return [client_name for client_name in names if client_name is not None]
+
+checkin_groups = CheckinGroups(CHECKIN_GROUPS_FILE)
 
 def ensure_data_file():
     """Создает файл данных если он не существует"""
     if not os.path.exists(DATA_FILE):
         with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump({}, f, ensure_ascii=False, indent=4)
+            f.write(dump_data({}))
         print(f"✅ Файл {DATA_FILE} создан автоматически")
 
+# ==================== ИМПОРТ И ЭКСПОРТ ====================
+
+# Названия столбцов при импорте (в нижнем регистре)
+IMPORT_COLUMNS = {
+    'name': ('имя', 'клиент', 'фио', 'name'),
+    'sessions': ('занятия', 'занятий', 'sessions'),
+    'phone': ('телефон', 'phone'),
+    'notes': ('заметки', 'примечание', 'notes'),
+    'group': ('группа', 'group'),
+}
+# Порядок столбцов, если в файле нет строки заголовка
+DEFAULT_IMPORT_COLUMNS = {'name': 0, 'sessions': 1, 'phone': 2, 'notes': 3, 'group': 4}
+EXPORT_DELIMITER = ';'  # Excel с русской локалью ожидает ';'
+EXPORT_BATCH = 1000  # Клиентов в одной порции выгрузки
+IMPORT_HELP = (
+    "Пришлите файл CSV или XLSX со столбцами: Имя, Занятия, Телефон, Заметки, Группа.\n"
+    "Занятия добавляются к текущему остатку, новые клиенты создаются."
+)
+
+def iter_table_rows(path):
+    """Построчно читает CSV или XLSX, не загружая файл в память целиком."""
+    if path.lower().endswith('.xlsx'):
+        from openpyxl import load_workbook  # Нужен только для XLSX
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield ['' if value is None else str(value).strip() for value in row]
+        finally:
+            workbook.close()
+        return
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        for row in csv.reader(f, dialect):
+            yield [value.strip() for value in row]
+
+def import_header(values):
+    """Номера столбцов по строке заголовка или None, если это не заголовок."""
+    columns = {}
+    for index, value in enumerate(values):
+        for field, aliases in IMPORT_COLUMNS.items():
+            if value.lower() in aliases and field not in columns:
+                columns[field] = index
+    if 'name' in columns and 'sessions' in columns:
+        return columns
+    return None
+
+def import_cell(values, columns, field):
+    """Значение столбца field в строке или '', если столбца нет."""
+    index = columns.get(field)
+    if index is None or index >= len(values):
+        return ''
+    return values[index]
+
+def parse_sessions(value):
+    """Количество занятий из ячейки: целое неотрицательное число (в XLSX может быть '5.0')."""
+    number = float(value.replace(',', '.'))
+    if number < 0 or not number.is_integer():
+        raise ValueError(value)
+    return int(number)
+
+def parse_import_file(path):
+    """Разбирает файл импорта.
+
+    Возвращает (строки [(имя, занятия, телефон, заметки, группа)], ошибки [(номер строки, текст)]).
+    """
+    rows, errors = [], []
+    columns = None
+    for line_no, values in enumerate(iter_table_rows(path), start=1):
+        if not any(values):
+            continue
+        if columns is None:
+            columns = import_header(values)
+            if columns is not None:
+                continue
+            columns = DEFAULT_IMPORT_COLUMNS
+        client_name = import_cell(values, columns, 'name')
+        if not client_name:
+            errors.append((line_no, "не указано имя"))
+            continue
+        try:
+            sessions = parse_sessions(import_cell(values, columns, 'sessions'))
+        except ValueError:
+            errors.append((line_no, f"{client_name}: количество занятий должно быть целым неотрицательным числом"))
+            continue
+        rows.append((client_name, sessions, import_cell(values, columns, 'phone'), import_cell(values, columns, 'notes'),
+                     import_cell(values, columns, 'group')))
+    return rows, errors
+
+async def import_clients(rows):
+    """Добавляет занятия клиентам из импорта, новых клиентов создает.
+
+    Все строки применяются вместе и сохраняются одной записью в хранилище.
+    Возвращает (новых клиентов, пополненных клиентов).
+    """
+    client_names = list(dict.fromkeys(client_name for client_name, _, _, _, _ in rows))
+    created = set()
+    async with contextlib.AsyncExitStack() as stack:
+        for client_name in sorted(client_names):
+            await stack.enter_async_context(store.lock(client_name))
+        data = load_data()
+        now = datetime.now()
+        for client_name, sessions, phone, notes, group in rows:
+            # Как и в add_sessions_to_client, строка без занятий оплатой не считается
+            paid_at = int(now.timestamp()) if sessions > 0 else 0
+            if client_name in data:
+                store.set_sessions(client_name, data[client_name].sessions + sessions)
+                if paid_at:
+                    store.set_payment_date(client_name, now)
+                if phone:
+                    data[client_name].phone = phone
+                if notes:
+                    data[client_name].notes = notes
+                if group:
+                    store.set_group(client_name, group)
+            else:
+                store.insert(client_name, Client(sessions, paid_at, phone=phone, notes=notes, group=group))
+                created.add(client_name)
+            if paid_at:
+                store.count_event('topup')
+        await store.record_many('topup', client_names)
+    return len(created), len(client_names) - len(created)
+
+def roster_states(client_names):
+    """Копии полей клиентов для выгрузки (в цикле событий); удаленные клиенты пропускаются."""
+    clients = store.clients
+    return [(client_name, clients[client_name].state()) for client_name in client_names if client_name in clients]
+
+def roster_rows(states):
+    """Строки выгрузки клиентов по копиям из roster_states()."""
+    for client_name, (sessions, paid_at, attended_at, phone, notes, _, group) in states:
+        yield (client_name, sessions, phone, notes, from_epoch(paid_at) or '', from_epoch(attended_at) or '', group)
+
+def history_states(client_names):
+    """Копии событий клиентов для выгрузки (в цикле событий); удаленные клиенты пропускаются."""
+    clients = store.clients
+    history = store.history
+    return [(client_name,
+             history.events(clients[client_name].id, ClientHistory.PAYMENT),
+             history.events(clients[client_name].id, ClientHistory.ATTEND))
+            for client_name in client_names if client_name in clients]
+
+def history_rows(states):
+    """Строки выгрузки истории по копиям из history_states(): события каждого клиента по времени."""
+    for client_name, payments, visits in states:
+        payments = ((moment, "оплата") for moment in payments)
+        visits = ((moment, "посещение") for moment in visits)
+        for moment, kind in heapq.merge(payments, visits):
+            yield (client_name, kind, datetime.fromtimestamp(moment).strftime('%Y-%m-%d %H:%M:%S'))
+
+async def send_export(bot, chat_id):
+    """Отправляет выгрузку клиентов и истории посещений двумя CSV-файлами.
+
+    Файлы пишутся во временные файлы по списку имен, снятому в начале
+    выгрузки, порциями по EXPORT_BATCH клиентов. Как и для снимков
+    хранилища, копия порции снимается в цикле событий, а строки из нее
+    собираются и пишутся в отдельном потоке, поэтому строка не смешивает
+    поля до и после изменения клиента, а копия всех данных не собирается.
+    """
+    client_names = list(store.sorted_names)
+    exports = (
+        ("clients.csv", ("Имя", "Занятия", "Телефон", "Заметки", "Последняя оплата", "Последнее посещение",
+                         "Группа"),
+         roster_states, roster_rows),
+        ("history.csv", ("Имя", "Событие", "Время"), history_states, history_rows),
+    )
+    for filename, header, copy_batch, rows in exports:
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        try:
+            with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+                writer = csv.writer(f, delimiter=EXPORT_DELIMITER)
+                writer.writerow(header)
+                for start in range(0, len(client_names), EXPORT_BATCH):
+                    states = copy_batch(client_names[start:start + EXPORT_BATCH])
+                    await asyncio.to_thread(writer.writerows, rows(states))
+            with open(path, 'rb') as f:
+                await bot.send_document(chat_id=chat_id, document=f, filename=filename)
+        finally:
+            os.remove(path)
+
+# ==================== ОТПРАВКА СООБЩЕНИЙ ====================
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """Делит текст на части не длиннее limit символов.
+
+    Режет по границам строк, чтобы пункты списков не разрывались;
+    строку длиннее limit режет на куски как есть.
+    """
+    chunks = []
+    current = []
+    size = 0
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                chunks.append('\n'.join(current))
+                current, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        extra = len(line) + (1 if current else 0)
+        if current and size + extra > limit:
+            chunks.append('\n'.join(current))
+            current, size, extra = [], 0, len(line)
+        current.append(line)
+        size += extra
+    if current:
+        chunks.append('\n'.join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+class OutboundQueue:
+    """Очередь исходящих сообщений с учетом ограничений Telegram.
+
+    Общий темп отправки не выше rate сообщений в секунду (0 - без
+    ограничения), в один чат - не чаще раза в chat_interval секунд (в
+    группу - group_interval).
+    Части одного текста уходят в чат по порядку: отправки в чат идут
+    под его блокировкой, а asyncio.Lock пропускает ожидающих по очереди.
+    На RetryAfter очередь ждет столько, сколько просит Telegram, на сетевые
+    ошибки повторяет с растущей паузой; прочие ошибки (чат не найден,
+    бот заблокирован) не повторяются.
+    """
+
+    def __init__(self, rate=SEND_RATE, attempts=SEND_ATTEMPTS,
+                 chat_interval=CHAT_SEND_INTERVAL, group_interval=GROUP_SEND_INTERVAL):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.attempts = attempts
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self._next_send = 0.0  # Время цикла событий, раньше которого нельзя отправлять
+        self._chat_next_send = {}
+        self._chat_locks = defaultdict(asyncio.Lock)
+        self._rate_lock = asyncio.Lock()
+
+    def _chat_interval(self, chat_id):
+        # У групп и каналов отрицательные chat_id
+        return self.group_interval if str(chat_id).startswith('-') else self.chat_interval
+
+    async def _wait_turn(self, chat_id):
+        loop = asyncio.get_running_loop()
+        delay = self._chat_next_send.get(chat_id, 0.0) - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with self._rate_lock:
+            delay = self._next_send - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_send = max(self._next_send, loop.time()) + self.interval
+        self._chat_next_send[chat_id] = loop.time() + self._chat_interval(chat_id)
+
+    async def _send_chunk(self, bot, chat_id, text):
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.attempts + 1):
+            await self._wait_turn(chat_id)
+            try:
+                return await bot.send_message(chat_id=chat_id, text=text)
+            except RetryAfter as e:
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                metrics.inc('outbound_retries_total', reason='flood')
+                # Лимит может быть общим для бота, поэтому ждут все чаты
+                self._next_send = max(self._next_send, loop.time() + delay)
+                if attempt == self.attempts:
+                    raise
+            except (BadRequest, Forbidden):
+                raise
+            except NetworkError:
+                metrics.inc('outbound_retries_total', reason='network')
+                if attempt == self.attempts:
+                    raise
+                await asyncio.sleep(2 ** (attempt - 1))
+
+    async def send(self, bot, chat_id, text):
+        """Отправляет текст в чат, при необходимости частями.
+
+        Возвращает None при успехе или исключение, из-за которого
+        отправка не удалась (оставшиеся части тогда не отправляются).
+        """
+        async with self._chat_locks[chat_id]:
+            for chunk in split_message(text):
+                try:
+                    await self._send_chunk(bot, chat_id, chunk)
+                except TelegramError as e:
+                    metrics.inc('outbound_failures_total')
+                    return e
+                metrics.inc('outbound_messages_total')
+        return None
+
+    async def deliver(self, bot, chat_ids, text):
+        """Отправляет текст нескольким получателям одновременно.
+
+        Возвращает словарь chat_id -> None или исключение.
+        """
+        errors = await asyncio.gather(*(self.send(bot, chat_id, text) for chat_id in chat_ids))
+        return dict(zip(chat_ids, errors))
+
+outbound = OutboundQueue()
+
 # ==================== СИСТЕМА НАПОМИНАНИЙ И ОТЧЕТОВ ====================
 
-async def send_reminders(application):
-    """Отправляет напоминания администратору о клиентах с 1 занятием."""
-    data = load_data()
-    reminders_sent = 0
-    
-    clients_with_one_session = []
-    for client_name, client_data in data.items():
-        sessions = client_data['sessions']
-        if sessions == REMINDER_THRESHOLD:
-            clients_with_one_session.append(client_name)
+class ExhaustionForecast:
+    """Прогноз, когда у клиентов закончатся занятия.
+
+    Частота посещений каждого клиента берется из истории за последние
+    FORECAST_WINDOW_DAYS дней (у новых клиентов - с первого посещения), и по
+    ней остаток занятий переводится в дни.
+    Все клиенты (или клиенты одной группы) считаются одним векторным
+    проходом NumPy. Результат хранится до следующего изменения данных
+    (store.version) или до смены дня.
+    """
+
+    def __init__(self, store, window_days):
+        self.store = store
+        self.window_days = window_days
+        self._cache = {}  # группа (None - все клиенты) -> (ключ, имена, остатки, дней до конца)
+
+    def _compute(self, client_ids, now):
+        store = self.store
+        names = [store.by_id[client_id] for client_id in client_ids]
+        sessions = np.fromiter((store.clients[client_name].sessions for client_name in names),
+                               dtype=np.int64, count=len(names))
+        attend = store.history.series[ClientHistory.ATTEND]
+        series = [attend.get(client_id) for client_id in client_ids]
+        lengths = np.fromiter((len(events) if events else 0 for events in series),
+                              dtype=np.int64, count=len(series))
+        # Все посещения одним массивом; owners - номер клиента для каждого посещения
+        visits = np.concatenate([np.frombuffer(events, dtype=np.uint32) for events in series if events]
+                                or [np.zeros(0, dtype=np.uint32)])
+        owners = np.repeat(np.arange(len(names)), lengths)
+        now_ts = int(now.timestamp())
+        in_window = (visits >= now_ts - self.window_days * 86400) & (visits <= now_ts)
+        counts = np.bincount(owners[in_window], minlength=len(names))
+        # Новичков считаем по времени с первого посещения, но не меньше недели
+        first = np.full(len(names), now_ts, dtype=np.int64)
+        has_visits = lengths > 0
+        first[has_visits] = visits[(np.cumsum(lengths) - lengths)[has_visits]]
+        span_days = np.clip((now_ts - first) / 86400, 7, self.window_days)
+        per_day = counts / span_days
+        with np.errstate(divide='ignore', invalid='ignore'):
+            days_left = np.where(per_day > 0, sessions / per_day, np.inf)
+        return names, sessions, days_left
+
+    def _columns(self, now, group):
+        key = (self.store.version, now.date())
+        cached = self._cache.get(group)
+        if cached is None or cached[0] != key:
+            if group is None:
+                client_ids = list(self.store.by_id)
+            else:
+                client_ids = [self.store.id_of(client_name) for client_name in self.store.group_members(group)]
+            cached = self._cache[group] = (key, *self._compute(client_ids, now))
+        return cached[1:]
+
+    def running_out(self, days=7, now=None, group=None):
+        """Клиенты (все или группы group), у которых занятия закончатся в ближайшие days дней.
+
+        Клиенты с остатком не больше REMINDER_THRESHOLD не включаются - о них
+        и так напоминают. Возвращает [(имя, остаток, примерная дата)] по возрастанию даты.
+        """
+        now = now or datetime.now()
+        names, sessions, days_left = self._columns(now, group)
+        selected = np.flatnonzero((sessions > REMINDER_THRESHOLD) & (days_left <= days))
+        selected = selected[np.argsort(days_left[selected], kind='stable')]
+        return [
+            (names[index], int(sessions[index]), now + timedelta(days=float(days_left[index])))
+            for index in selected
+        ]
+
+forecast = ExhaustionForecast(store, FORECAST_WINDOW_DAYS)
+
+def running_out_labels(forecast_items):
+    """Подписи клиентов для раздела "закончатся на этой неделе"."""
+    return [
+        f"{client_name} - {sessions} зан., примерно {runs_out.strftime('%d.%m')}"
+        for client_name, sessions, runs_out in forecast_items
+    ]
+
+def reminders_text(group=None):
+    """Текст напоминаний по всем клиентам или по группе и число клиентов в нем."""
+    clients_with_one_session = store.clients_with_sessions(REMINDER_THRESHOLD, group)
+    running_out = forecast.running_out(group=group)
     
+    message = ""
     if clients_with_one_session:
-        message = "🔔 КЛИЕНТЫ С 1 ЗАНЯТИЕМ:\n\n"
+        message += "🔔 КЛИЕНТЫ С 1 ЗАНЯТИЕМ:\n\n"
         for client_name in clients_with_one_session:
             message += f"• {client_name}\n"
+        message += f"\nВсего клиентов с 1 занятием: {len(clients_with_one_session)}\n\n"
+    
+    if running_out:
+        message += "⏳ ЗАКОНЧАТСЯ НА ЭТОЙ НЕДЕЛЕ:\n\n"
+        for label in running_out_labels(running_out):
+            message += f"• {label}\n"
+    
+    return message.rstrip(), len(clients_with_one_session) + len(running_out)
+
+async def send_reminders(application):
+    """Отправляет напоминания о клиентах с 1 занятием и о клиентах, у которых
+    по прогнозу занятия закончатся на этой неделе: администратору - по всем
+    клиентам, тренерам групп - только по их группе.
+
+    Возвращает число клиентов в напоминании администратору."""
+    reminders_sent = 0
+    for group, chat_ids in [(None, REPORT_CHAT_IDS), *GROUP_CHAT_IDS.items()]:
+        message, count = reminders_text(group)
+        if not count:
+            continue
         
-        message += f"\nВсего клиентов с 1 занятием: {len(clients_with_one_session)}"
-        
-        if ADMIN_CHAT_ID:
-            try:
-                await application.bot.send_message(
-                    chat_id=ADMIN_CHAT_ID,
-                    text=message
-                )
-                reminders_sent = len(clients_with_one_session)
-                print(f"✅ Отправлены напоминания для {reminders_sent} клиентов")
-            except Exception as e:
-                print(f"❌ Ошибка отправки напоминаний: {e}")
+        results = await outbound.deliver(application.bot, chat_ids, message)
+        for chat_id, error in results.items():
+            if error is not None:
+                print(f"❌ Ошибка отправки напоминаний в чат {chat_id}: {error}")
+        if any(error is None for error in results.values()):
+            if group is None:
+                reminders_sent = count
+                print(f"✅ Отправлены напоминания для {count} клиентов")
+            else:
+                print(f"✅ Отправлены напоминания группы {group} для {count} клиентов")
     
     return reminders_sent
 
+def build_report(start, end, title="📊 ЕЖЕМЕСЯЧНЫЙ ОТЧЕТ", group=None):
+    """Собирает отчет за период [start, end) по всем клиентам или по группе.
+
+    Текущие остатки берутся из индекса по занятиям, а разделы за период
+    считаются по истории клиентов: для каждого клиента это две бисекции
+    по его рядам событий. Отчет группы перебирает только ее клиентов.
+    Текст собирается списком строк и склеивается один раз.
+    """
+    start_ts, end_ts = int(start.timestamp()), math.ceil(end.timestamp())
+    history = store.history
+    if group is None:
+        clients = store.by_id.items()
+    else:
+        clients = [(store.id_of(client_name), client_name) for client_name in store.group_members(group)]
+    paid_in_period = []
+    attended_in_period = 0
+    visits_in_period = 0
+    for client_id, client_name in clients:
+        if history.count(client_id, ClientHistory.PAYMENT, start_ts, end_ts):
+            paid_in_period.append(client_name)
+        visits = history.count(client_id, ClientHistory.ATTEND, start_ts, end_ts)
+        if visits:
+            attended_in_period += 1
+            visits_in_period += visits
+    
+    stats = store.stats(group)
+    lines = [
+        title,
+        f"🗓 Период: {start.strftime('%d.%m.%Y')} - {(end - timedelta(seconds=1)).strftime('%d.%m.%Y')}",
+        "",
+        f"👥 Всего клиентов: {stats['clients']}",
+        f"🎫 Всего занятий в абонементах: {stats['sessions']}",
+        f"🆕 Новых клиентов за период: {len(paid_in_period)}",
+        f"✅ Посещали занятия за период: {attended_in_period}",
+        f"🏃 Посещений за период: {visits_in_period}",
+        f"💳 Пополнений в этом месяце: {stats['month_topups']}",
+        f"✅ Посещений в этом месяце: {stats['month_attendances']}",
+        "",
+    ]
+    
+    sections = (
+        ("🔔 КЛИЕНТЫ С 1 ЗАНЯТИЕМ:", store.clients_with_sessions(REMINDER_THRESHOLD, group)),
+        ("❌ КЛИЕНТЫ С 0 ЗАНЯТИЙ:", store.clients_with_sessions(0, group)),
+        ("⏳ ЗАКОНЧАТСЯ НА ЭТОЙ НЕДЕЛЕ:", running_out_labels(forecast.running_out(now=end, group=group))),
+        ("🆕 НОВЫЕ КЛИЕНТЫ:", paid_in_period),
+    )
+    for header, names in sections:
+        if names:
+            lines.append(header)
+            lines.extend(f"• {client_name}" for client_name in names)
+            lines.append("")
+    
+    return "\n".join(lines).rstrip()
+
 async def send_monthly_report(application):
-    """Отправляет ежемесячный отчет администратору."""
-    if not ADMIN_CHAT_ID:
-        print("❌ ADMIN_CHAT_ID не указан, отчет не отправлен")
+    """Отправляет ежемесячный отчет администратору, а тренерам групп - отчеты по их группам."""
+    if not REPORT_CHAT_IDS and not GROUP_CHAT_IDS:
+        print("❌ ADMIN_CHAT_ID, REPORT_CHAT_IDS и GROUP_CHAT_IDS не указаны, отчет не отправлен")
         return
+    
+    now = datetime.now()
+    start = now - timedelta(days=30)
+    reports = []
+    if REPORT_CHAT_IDS:
+        reports.append(("", REPORT_CHAT_IDS, build_report(start, now)))
+    for group, chat_ids in GROUP_CHAT_IDS.items():
+        title = f"📊 ЕЖЕМЕСЯЧНЫЙ ОТЧЕТ ГРУППЫ {group}"
+        reports.append((f" группы {group}", chat_ids, build_report(start, now, title=title, group=group)))
+
+    for label, chat_ids, report in reports:
+        results = await outbound.deliver(application.bot, chat_ids, report)
+        for chat_id, error in results.items():
+            if error is None:
+                print(f"✅ Ежемесячный отчет{label} отправлен в чат {chat_id}")
+            else:
+                print(f"❌ Ошибка отправки отчета{label} в чат {chat_id}: {error}")
+
+class CronSchedule:
+    """Расписание в формате cron: "минуты часы дни_месяца месяцы дни_недели".
+
+    Поля поддерживают *, числа, диапазоны a-b, шаг /n и списки через запятую.
+    L в поле дней месяца означает последний день месяца. Дни недели 0-6,
+    воскресенье - 0 или 7. Если заданы и дни месяца, и дни недели, подходит
+    любой из них, как в cron.
+    """
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Расписание должно состоять из 5 полей: {expression!r}")
+        self.expression = expression
+        minutes, hours, days, months, weekdays = fields
+        self.minutes = sorted(self._parse(minutes, 0, 59))
+        self.hours = sorted(self._parse(hours, 0, 23))
+        day_items = days.split(',')
+        self.last_day = 'L' in day_items
+        day_items = [item for item in day_items if item != 'L']
+        self.days = self._parse(','.join(day_items), 1, 31) if day_items else set()
+        self.months = self._parse(months, 1, 12)
+        self.weekdays = {day % 7 for day in self._parse(weekdays, 0, 7)}
+        self.days_restricted = days != '*'
+        self.weekdays_restricted = weekdays != '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for item in field.split(','):
+            step = 1
+            if '/' in item:
+                item, step = item.split('/')
+                step = int(step)
+            if item == '*':
+                first, last = low, high
+            elif '-' in item:
+                first, last = (int(part) for part in item.split('-'))
+            else:
+                first = last = int(item)
+            if first < low or last > high or first > last or step < 1:
+                raise ValueError(f"Недопустимое значение в расписании: {field!r}")
+            values.update(range(first, last + 1, step))
+        return values
+
+    def matches_day(self, day):
+        """Подходит ли дата по месяцу, дню месяца и дню недели."""
+        if day.month not in self.months:
+            return False
+        day_ok = day.day in self.days or (self.last_day and (day + timedelta(days=1)).day == 1)
+        weekday_ok = day.isoweekday() % 7 in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return day_ok or weekday_ok
+        if self.days_restricted:
+            return day_ok
+        if self.weekdays_restricted:
+            return weekday_ok
+        return True
+
+    def next_after(self, moment):
+        """Ближайшее время запуска строго позже moment."""
+        start = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.date()
+        # За 5 лет встретится любая дата, включая 29 февраля
+        for _ in range(366 * 5):
+            if self.matches_day(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = datetime.combine(day, dt_time(hour, minute))
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError(f"Расписание никогда не срабатывает: {self.expression!r}")
+
+class Scheduler:
+    """Запускает задачи по расписаниям cron.
+
+    Ближайшие запуски лежат в куче, и планировщик спит до самого раннего из
+    них, а не просыпается каждую минуту. Время последнего запуска каждой
+    задачи сохраняется в state_file: если бот был выключен в момент запуска,
+    задача выполняется сразу после старта.
+    """
+
+    # Спим не дольше часа, чтобы заметить перевод системных часов
+    MAX_SLEEP = 3600
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.jobs = []
+        self.last_run = {}
+        self.running = False
+        self._heap = []
+
+    def add_job(self, name, schedule, func):
+        """Добавляет задачу: func - корутина без аргументов."""
+        self.jobs.append((name, CronSchedule(schedule), func))
+
+    def load_state(self):
+        """Читает время последних запусков задач."""
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                try:
+                    state = json.load(f)
+                except json.JSONDecodeError:
+                    state = {}
+            self.last_run = {name: datetime.fromisoformat(moment) for name, moment in state.items()}
+
+    def next_runs(self):
+        """Ближайшие запуски задач: [(время, имя)] по возрастанию."""
+        return sorted((due, self.jobs[index][0]) for due, index in self._heap)
+
+    async def run(self):
+        """Выполняет задачи по расписанию, пока бот работает."""
+        self.load_state()
+        now = datetime.now()
+        self._heap = []
+        for index, (name, schedule, func) in enumerate(self.jobs):
+            last_run = self.last_run.get(name)
+            if last_run is not None and schedule.next_after(last_run) <= now:
+                # Пропущенный запуск выполняем сразу
+                print(f"⏰ Догоняем пропущенную задачу: {name}")
+                due = now
+            else:
+                due = schedule.next_after(now)
+            # Индекс задачи в куче сохраняет порядок добавления при одинаковом времени
+            heapq.heappush(self._heap, (due, index))
         
+        self.running = True
+        try:
+            while self._heap:
+                due, index = self._heap[0]
+                delay = (due - datetime.now()).total_seconds()
+                if delay > 0:
+                    await asyncio.sleep(min(delay, self.MAX_SLEEP))
+                    continue
+                heapq.heappop(self._heap)
+                name, schedule, func = self.jobs[index]
+                started = datetime.now()
+                try:
+                    with metrics.timer('job', job=name):
+                        await func()
+                    print(f"✅ Задача {name} выполнена {started.strftime('%d.%m.%Y %H:%M')}")
+                except Exception as e:
+                    metrics.inc('job_errors_total', job=name)
+                    print(f"❌ Ошибка задачи {name}: {e}")
+                self.last_run[name] = started
+                await self._save_state()
+                heapq.heappush(self._heap, (schedule.next_after(started), index))
+        finally:
+            self.running = False
+
+    async def _save_state(self):
+        state = {name: moment.isoformat() for name, moment in self.last_run.items()}
+        await asyncio.to_thread(atomic_write, self.state_file, json.dumps(state, ensure_ascii=False, indent=4))
+
+scheduler = Scheduler(SCHEDULER_STATE_FILE)
+
+async def schedule_tasks(application):
+    """Планирует задачи."""
+    scheduler.add_job('monthly_report', REPORT_SCHEDULE, lambda: send_monthly_report(application))
+    scheduler.add_job('reminders', REMINDER_SCHEDULE, lambda: send_reminders(application))
+    await scheduler.run()
+
+# ==================== СОЗДАНИЕ КЛАВИАТУР ====================
+
+class RenderCache:
+    """LRU-кэш готовых клавиатур и текстов экранов.
+
+    В ключ входит версия данных, из которых построен экран (store.version
+    или ревизия клиента), поэтому после изменения данных старая запись
+    просто больше не запрашивается и со временем вытесняется.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """Готовое значение по ключу; при промахе строит его через build()."""
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = self.entries[key] = build()
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return value
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+def cached_view(key):
+    """Кэширует результат функции экрана в render_cache.
+
+    key(*args) возвращает версию данных экрана: кортеж, который меняется
+    вместе с данными, из которых экран построен.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def cached(*args):
+            return render_cache.get((func.__name__,) + key(*args), lambda: func(*args))
+        return cached
+    return decorate
+
+def client_view_key(client_name):
+    """Ключ экранов клиента: ревизия клиента и страница списка для кнопки возврата."""
+    return (client_name, store.revision(client_name), store.page_of(client_name, CLIENTS_PAGE_SIZE))
+
+@cached_view(lambda: ())
+def main_menu_keyboard():
+    """Создает главное меню."""
+    keyboard = [
+        [InlineKeyboardButton("📋 Список клиентов", callback_data="l:0")],
+        [InlineKeyboardButton("🔍 Поиск клиента", callback_data="f")],
+        [InlineKeyboardButton("➕ Добавить клиента", callback_data="n")],
+        [InlineKeyboardButton("👥 Групповая отметка", callback_data="g")],
+        [InlineKeyboardButton("📊 Статистика", callback_data="st")],
+        [InlineKeyboardButton("📤 Выгрузка в CSV", callback_data="ex")],
+        [InlineKeyboardButton("🔔 Тест напоминаний", callback_data="tr")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+@cached_view(lambda page=0: (page, store.version))
+def clients_list_keyboard(page=0):
+    """Создает клавиатуру с одной страницей списка клиентов."""
     data = load_data()
-    total_clients = len(data)
-    total_sessions = sum(client_data['sessions'] for client_data in data.values())
-    
-    # Клиенты с 1 занятием
-    clients_with_one_session = []
-    for client_name, client_data in data.items():
-        if client_data['sessions'] == REMINDER_THRESHOLD:
-            clients_with_one_session.append(client_name)
-    
-    # Клиенты с 0 занятий
-    clients_with_zero_sessions = []
-    for client_name, client_data in data.items():
-        if client_data['sessions'] == 0:
-            clients_with_zero_sessions.append(client_name)
-    
-    # Новые клиенты за последний месяц
-    month_ago = datetime.now() - timedelta(days=30)
-    new_clients = []
-    for client_name, client_data in data.items():
-        payment_date = datetime.fromisoformat(client_data['last_payment_date'])
-        if payment_date >= month_ago:
-            new_clients.append(client_name)
-    
-    # Формируем отчет
-    report = "📊 ЕЖЕМЕСЯЧНЫЙ ОТЧЕТ\n\n"
-    report += f"👥 Всего клиентов: {total_clients}\n"
-    report += f"🎫 Всего занятий в абонементах: {total_sessions}\n"
-    report += f"🆕 Новых клиентов за месяц: {len(new_clients)}\n\n"
+    keyboard = []
     
-    if clients_with_one_session:
-        report += "🔔 КЛИЕНТЫ С 1 ЗАНЯТИЕМ:\n"
-        for client_name in clients_with_one_session:
-            report += f"• {client_name}\n"
-        report += f"\n"
+    for client_name in store.page(page, CLIENTS_PAGE_SIZE):
+        client = data[client_name]
+        button_text = f"{client_name} ({client.sessions} занятий)"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"c:{client.id}")])
+    
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data=f"l:{page - 1}"))
+    if page < store.page_count(CLIENTS_PAGE_SIZE) - 1:
+        navigation.append(InlineKeyboardButton("Вперед ▶️", callback_data=f"l:{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+    
+    keyboard.append([InlineKeyboardButton("🔙 Главное меню", callback_data="m")])
+    return InlineKeyboardMarkup(keyboard)
+
+def search_results_keyboard(client_names):
+    """Создает клавиатуру с найденными клиентами."""
+    data = load_data()
+    keyboard = []
     
-    if clients_with_zero_sessions:
-        report += "❌ КЛИЕНТЫ С 0 ЗАНЯТИЙ:\n"
-        for client_name in clients_with_zero_sessions:
-            report += f"• {client_name}\n"
-        report += f"\n"
+    for client_name in client_names:
+        client = data[client_name]
+        button_text = f"{client_name} ({client.sessions} занятий)"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"c:{client.id}")])
     
-    if new_clients:
-        report += f"🆕 НОВЫЕ КЛИЕНТЫ:\n" + "\n".join([f"• {name}" for name in new_clients])
+    keyboard.append([InlineKeyboardButton("🔍 Новый поиск", callback_data="f")])
+    keyboard.append([InlineKeyboardButton("🔙 Главное меню", callback_data="m")])
+    return InlineKeyboardMarkup(keyboard)
+
+def client_group_key(group):
+    """Короткий ключ группы клиентов для callback_data (название может не влезть в 64 байта)."""
+    return format(zlib.crc32(group.encode('utf-8')), 'x')
+
+def checkin_groups_keyboard():
+    """Создает клавиатуру с группами клиентов и сохраненными группами для групповой отметки."""
+    keyboard = []
+    for group in store.groups():
+        keyboard.append([InlineKeyboardButton(f"🏷 {group} ({len(store.group_members(group))})",
+                                              callback_data=f"gp:{client_group_key(group)}")])
+    for group_id, group in checkin_groups.groups.items():
+        keyboard.append([
+            InlineKeyboardButton(f"👥 {group['name']} ({len(group['clients'])})", callback_data=f"gg:{group_id}"),
+            InlineKeyboardButton("🗑️", callback_data=f"gx:{group_id}")
+        ])
+    keyboard.append([InlineKeyboardButton("☑️ Выбрать клиентов", callback_data="gs:0")])
+    keyboard.append([InlineKeyboardButton("🔙 Главное меню", callback_data="m")])
+    return InlineKeyboardMarkup(keyboard)
+
+def checkin_select_keyboard(selected, page=0):
+    """Создает клавиатуру выбора клиентов для групповой отметки."""
+    data = load_data()
+    keyboard = []
+    
+    for client_name in store.page(page, CLIENTS_PAGE_SIZE):
+        client = data[client_name]
+        mark = "✅" if client.id in selected else "▫️"
+        button_text = f"{mark} {client_name} ({client.sessions})"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"gt:{client.id}:{page}")])
+    
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data=f"gs:{page - 1}"))
+    if page < store.page_count(CLIENTS_PAGE_SIZE) - 1:
+        navigation.append(InlineKeyboardButton("Вперед ▶️", callback_data=f"gs:{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+    
+    keyboard.append([InlineKeyboardButton(f"✔️ Отметить выбранных ({len(selected)})", callback_data="ga")])
+    keyboard.append([
+        InlineKeyboardButton("💾 Сохранить группу", callback_data="gv"),
+        InlineKeyboardButton("🧹 Сбросить", callback_data="gc")
+    ])
+    keyboard.append([InlineKeyboardButton("🔙 К группам", callback_data="g")])
+    return InlineKeyboardMarkup(keyboard)
+
+@cached_view(client_view_key)
+def client_actions_keyboard(client_name):
+    """Создает клавиатуру действий для конкретного клиента."""
+    client_id = store.id_of(client_name)
+    keyboard = [
+        [InlineKeyboardButton("✅ Отметить посещение", callback_data=f"a:{client_id}")],
+        [InlineKeyboardButton("➕ Добавить занятия", callback_data=f"s:{client_id}")],
+        [InlineKeyboardButton("📋 Информация", callback_data=f"i:{client_id}")],
+        [InlineKeyboardButton("📅 История посещений", callback_data=f"h:{client_id}")],
+        [InlineKeyboardButton("🏷 Группа", callback_data=f"cg:{client_id}")],
+        [InlineKeyboardButton("📊 Проверить остаток", callback_data=f"k:{client_id}")],
+        [InlineKeyboardButton("🗑️ Удалить клиента", callback_data=f"d:{client_id}")],
+        [InlineKeyboardButton("🔙 К списку клиентов",
+                              callback_data=f"l:{store.page_of(client_name, CLIENTS_PAGE_SIZE)}")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def delete_confirmation_keyboard(client_name):
+    """Создает клавиатуру подтверждения удаления."""
+    client_id = store.id_of(client_name)
+    keyboard = [
+        [InlineKeyboardButton("❌ Да, удалить", callback_data=f"x:{client_id}")],
+        [InlineKeyboardButton("✅ Нет, оставить", callback_data=f"c:{client_id}")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+@cached_view(lambda: ())
+def back_to_main_menu_keyboard():
+    """Клавиатура для возврата в главное меню."""
+    keyboard = [
+        [InlineKeyboardButton("🔙 Главное меню", callback_data="m")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# ==================== ОБРАБОТЧИКИ КОМАНД ====================
+
+@timed('handler', handler='start')
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /start."""
+    print("✅ Команда /start получена!")
+    await update.message.reply_text(
+        "👯‍♀️ Учет занятий Чирлидинг (4+)\n\n"
+        "Выберите действие:",
+        reply_markup=main_menu_keyboard()
+    )
+
+def parse_report_period(args):
+    """Разбирает период отчета из аргументов команды /report.
+
+    Без аргументов - последние 30 дней; одна дата ДД.ММ.ГГГГ - с этой даты
+    по сегодня; две даты - с первой по вторую включительно.
+    """
+    now = datetime.now()
+    if not args:
+        return now - timedelta(days=30), now
+    start = datetime.strptime(args[0], '%d.%m.%Y')
+    if len(args) > 1:
+        end = datetime.strptime(args[1], '%d.%m.%Y') + timedelta(days=1)
+    else:
+        end = now
+    return start, end
+
+@timed('handler', handler='report')
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /report [с ДД.ММ.ГГГГ] [по ДД.ММ.ГГГГ]."""
+    try:
+        start_date, end_date = parse_report_period(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Укажите даты в формате ДД.ММ.ГГГГ, например:\n"
+            "/report 01.01.2026 31.12.2026"
+        )
+        return
+    if start_date >= end_date:
+        await update.message.reply_text("❌ Начало периода должно быть раньше конца")
+        return
+    
+    report = build_report(start_date, end_date, title="📊 ОТЧЕТ ЗА ПЕРИОД")
+    error = await outbound.send(context.bot, update.effective_chat.id, report)
+    if error is not None:
+        print(f"❌ Ошибка отправки отчета: {error}")
+
+SEARCH_PROMPT = "🔍 Поиск клиента\n\nВведите имя, фамилию или их начало:"
+
+async def reply_search_results(update, text):
+    """Отвечает списком клиентов, найденных по запросу."""
+    client_names = store.search(text, SEARCH_LIMIT)
+    if client_names:
+        message = f"🔍 Найдено по запросу «{text}»:"
+    else:
+        message = f"❌ По запросу «{text}» никого не найдено"
+    await update.message.reply_text(message, reply_markup=search_results_keyboard(client_names))
+
+@timed('handler', handler='find')
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /find [имя]; без аргумента ждет запрос следующим сообщением."""
+    text = ' '.join(context.args)
+    if not text:
+        context.user_data['awaiting_search'] = True
+        await update.message.reply_text(SEARCH_PROMPT, reply_markup=back_to_main_menu_keyboard())
+        return
+    await reply_search_results(update, text)
+
+# Данные кнопок имеют вид "<код действия>:<аргумент>", например "a:123" -
+# отметить посещение клиента с id 123. Так они укладываются в 64 байта,
+# которые Telegram допускает для callback_data, при любой длине имени.
+CALLBACK_ROUTES = {}
+
+def callback_route(action):
+    """Регистрирует обработчик кнопки: func(query, context, arg)."""
+    def register(func):
+        CALLBACK_ROUTES[action] = func
+        return func
+    return register
+
+def client_callback_route(action):
+    """Регистрирует обработчик кнопки клиента: func(query, context, client_name).
+
+    Аргумент кнопки - id клиента; если клиента уже нет, показывается главное меню.
+    """
+    def register(func):
+        async def resolve_client(query, context, arg):
+            client_name = store.name_of(int(arg)) if arg.isdigit() else None
+            if client_name is None:
+                await query.edit_message_text(
+                    "❌ Клиент не найден",
+                    reply_markup=main_menu_keyboard()
+                )
+                return
+            await func(query, context, client_name)
+        CALLBACK_ROUTES[action] = resolve_client
+        return func
+    return register
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик нажатий на кнопки.
+
+    Время обработки учитывается в метриках отдельно для каждого действия.
+    """
+    query = update.callback_query
+    callback_data = query.data
+    action, _, arg = callback_data.partition(':')
+    handler = CALLBACK_ROUTES.get(action)
+    
+    with metrics.timer('callback', action=action if handler is not None else 'unknown'):
+        await query.answer()
+        print(f"✅ Нажата кнопка: {callback_data}")
+        
+        if handler is None:
+            # Кнопка из сообщения, отправленного до смены формата callback_data
+            await query.edit_message_text(
+                "⚠️ Это меню устарело.\n\nВыберите действие:",
+                reply_markup=main_menu_keyboard()
+            )
+            return
+        await handler(query, context, arg)
+
+@callback_route("m")
+async def show_main_menu(query, context, arg):
+    await query.edit_message_text(
+        "👯‍♀️ Учет занятий Чирлидинг (4+)\n\nВыберите действие:",
+        reply_markup=main_menu_keyboard()
+    )
+
+@callback_route("l")
+async def show_clients_list(query, context, arg):
+    data = load_data()
+    if not data:
+        await query.edit_message_text(
+            "📝 Список клиентов пуст.",
+            reply_markup=main_menu_keyboard()
+        )
+    else:
+        page = int(arg) if arg.isdigit() else 0
+        # Страница могла исчезнуть, если клиентов удалили
+        page = min(page, store.page_count(CLIENTS_PAGE_SIZE) - 1)
+        await query.edit_message_text(
+            f"👥 Выберите клиента (страница {page + 1} из {store.page_count(CLIENTS_PAGE_SIZE)}):",
+            reply_markup=clients_list_keyboard(page)
+        )
+
+@callback_route("n")
+async def ask_new_client_name(query, context, arg):
+    context.user_data['awaiting_client_name'] = True
+    await query.edit_message_text(
+        "👤 Добавление нового клиента\n\n"
+        "Введите имя нового клиента:",
+        reply_markup=back_to_main_menu_keyboard()
+    )
 
+@callback_route("f")
+async def ask_search_query(query, context, arg):
+    context.user_data['awaiting_search'] = True
+    await query.edit_message_text(SEARCH_PROMPT, reply_markup=back_to_main_menu_keyboard())
+
+@callback_route("ex")
+async def export_roster(query, context, arg):
+    await query.edit_message_text("📤 Готовлю выгрузку...")
     try:
-        await application.bot.send_message(
-            chat_id=ADMIN_CHAT_ID,
-            text=report
-        )
-        print("✅ Ежемесячный отчет отправлен")
+        await send_export(context.bot, query.message.chat_id)
+        message = f"✅ Выгрузка отправлена\n\n📥 {IMPORT_HELP}"
     except Exception as e:
-        print(f"❌ Ошибка отправки отчета: {e}")
+        print(f"❌ Ошибка выгрузки: {e}")
+        message = "❌ Не удалось отправить выгрузку"
+    await query.edit_message_text(
+        message,
+        reply_markup=main_menu_keyboard()
+    )
 
-def is_monthly_report_day():
-    """Проверяет, сегодня ли день для ежемесячного отчета (30-е или 28-е в феврале)."""
-    now = datetime.now()
-    day = now.day
-    month = now.month
+@callback_route("st")
+async def show_statistics(query, context, arg):
+    stats = store.stats()
     
-    # Февраль - 28-е
-    if month == 2 and day == 28:
-        return True
-    # Все остальные месяцы - 30-е
-    elif day == 30:
-        return True
+    message = "📊 Статистика:\n\n"
+    message += f"Всего клиентов: {stats['clients']}\n"
+    message += f"Всего занятий в абонементах: {stats['sessions']}\n"
+    message += f"Клиентов с 0 занятий: {stats['at_zero']}\n"
+    message += f"Пополнений в этом месяце: {stats['month_topups']}\n"
+    message += f"Посещений в этом месяце: {stats['month_attendances']}\n"
+    
+    if stats['at_threshold']:
+        message += f"\n🔔 Клиентов с 1 занятием: {stats['at_threshold']}\n"
+        for client_name in itertools.islice(store.by_sessions[REMINDER_THRESHOLD], 5):
+            message += f"• {client_name}\n"
+        if stats['at_threshold'] > 5:
+            message += f"... и еще {stats['at_threshold'] - 5}\n"
     
-    return False
+    await query.edit_message_text(
+        message,
+        reply_markup=main_menu_keyboard()
+    )
 
-async def schedule_tasks(application):
-    """Планирует задачи."""
-    last_report_sent = None
+@callback_route("tr")
+async def test_reminders(query, context, arg):
+    sent_count = await send_reminders(context.application)
+    if sent_count > 0:
+        message = f"✅ Тестовые напоминания отправлены для {sent_count} клиентов"
+    else:
+        message = "✅ Нет клиентов с 1 занятием для напоминаний"
     
-    while True:
-        now = datetime.now()
-        
-        # Проверяем, нужно ли отправить ежемесячный отчет
-        if (is_monthly_report_day() and 
-            now.hour == REPORT_HOUR and 
-            now.minute == 0 and
-            (last_report_sent is None or last_report_sent.date() != now.date())):
-            
-            await send_monthly_report(application)
-            await send_reminders(application)
-            last_report_sent = now
-            print(f"✅ Ежемесячные задачи выполнены {now.strftime('%d.%m.%Y %H:%M')}")
-        
-        # Проверяем напоминания каждый день в 10:00
-        elif (now.hour == REPORT_HOUR and 
-              now.minute == 0 and
-              (last_report_sent is None or last_report_sent.date() != now.date())):
-            
-            await send_reminders(application)
-            last_report_sent = now
-            print(f"✅ Ежедневные напоминания отправлены {now.strftime('%d.%m.%Y %H:%M')}")
-        
-        # Ждем 1 минуту до следующей проверки
-        await asyncio.sleep(60)
+    await query.edit_message_text(
+        message,
+        reply_markup=main_menu_keyboard()
+    )
 
-# ==================== СОЗДАНИЕ КЛАВИАТУР ====================
+@cached_view(client_view_key)
+def client_card_text(client_name):
+    """Текст карточки клиента."""
+    return (
+        f"👤 Клиент: {client_name}\n"
+        f"📊 Осталось занятий: {get_remaining_sessions(client_name)}\n\n"
+        "Выберите действие:"
+    )
 
-def main_menu_keyboard():
-    """Создает главное меню."""
-    keyboard = [
-        [InlineKeyboardButton("📋 Список клиентов", callback_data="list_clients")],
-        [InlineKeyboardButton("➕ Добавить клиента", callback_data="add_client")],
-        [InlineKeyboardButton("📊 Статистика", callback_data="statistics")],
-        [InlineKeyboardButton("🔔 Тест напоминаний", callback_data="test_reminders")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+@client_callback_route("c")
+async def show_client(query, context, client_name):
+    await query.edit_message_text(
+        client_card_text(client_name),
+        reply_markup=client_actions_keyboard(client_name)
+    )
 
-def clients_list_keyboard():
-    """Создает клавиатуру со списком клиентов."""
-    data = load_data()
-    keyboard = []
+@cached_view(client_view_key)
+def client_info_text(client_name):
+    """Текст с полной информацией о клиенте."""
+    client_info = get_client_info(client_name)
     
-    for client_name in sorted(data.keys()):
-        sessions = data[client_name]['sessions']
-        button_text = f"{client_name} ({sessions} занятий)"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"client_{client_name}")])
+    message = f"👤 Информация о клиенте:\n\n"
+    message += f"Имя: {client_name}\n"
+    message += f"Занятий: {client_info.sessions}\n"
     
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="main_menu")])
-    return InlineKeyboardMarkup(keyboard)
+    if client_info.paid_at:
+        payment_date = datetime.fromtimestamp(client_info.paid_at)
+        message += f"Последняя оплата: {payment_date.strftime('%d.%m.%Y')}\n"
+    
+    if client_info.attended_at:
+        last_attendance = datetime.fromtimestamp(client_info.attended_at)
+        message += f"Последнее посещение: {last_attendance.strftime('%d.%m.%Y')}\n"
+    
+    if client_info.phone:
+        message += f"Телефон: {client_info.phone}\n"
+    
+    if client_info.notes:
+        message += f"Заметки: {client_info.notes}\n"
+    
+    if client_info.group:
+        message += f"Группа: {client_info.group}\n"
+    
+    return message
 
-def client_actions_keyboard(client_name):
-    """Создает клавиатуру действий для конкретного клиента."""
-    keyboard = [
-        [InlineKeyboardButton("✅ Отметить посещение", callback_data=f"attend_{client_name}")],
-        [InlineKeyboardButton("➕ Добавить занятия", callback_data=f"add_sessions_{client_name}")],
-        [InlineKeyboardButton("📋 Информация", callback_data=f"info_{client_name}")],
-        [InlineKeyboardButton("📊 Проверить остаток", callback_data=f"check_{client_name}")],
-        [InlineKeyboardButton("🗑️ Удалить клиента", callback_data=f"delete_ask_{client_name}")],
-        [InlineKeyboardButton("🔙 К списку клиентов", callback_data="list_clients")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+@client_callback_route("cg")
+async def ask_client_group(query, context, client_name):
+    context.user_data['awaiting_client_group'] = True
+    context.user_data['group_client'] = client_name
+    current = get_client_info(client_name).group or "не указана"
+    message = f"🏷 Группа клиента {client_name}: {current}\n\n"
+    groups = store.groups()
+    if groups:
+        message += "Существующие группы:\n" + "".join(f"• {group}\n" for group in groups) + "\n"
+    message += "Введите название группы или «-», чтобы убрать клиента из группы:"
+    await query.edit_message_text(
+        message,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Назад", callback_data=f"c:{store.id_of(client_name)}")]
+        ])
+    )
 
-def delete_confirmation_keyboard(client_name):
-    """Создает клавиатуру подтверждения удаления."""
-    keyboard = [
-        [InlineKeyboardButton("❌ Да, удалить", callback_data=f"delete_confirm_{client_name}")],
-        [InlineKeyboardButton("✅ Нет, оставить", callback_data=f"client_{client_name}")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+@client_callback_route("i")
+async def show_client_info(query, context, client_name):
+    await query.edit_message_text(
+        client_info_text(client_name),
+        reply_markup=client_actions_keyboard(client_name)
+    )
 
-def back_to_main_menu_keyboard():
-    """Клавиатура для возврата в главное меню."""
-    keyboard = [
-        [InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+WEEKDAY_NAMES = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
 
-# ==================== ОБРАБОТЧИКИ КОМАНД ====================
+@cached_view(lambda client_name: client_view_key(client_name) + (datetime.now().date(),))
+def client_history_text(client_name):
+    """Текст истории посещений клиента; зависит и от сегодняшней даты."""
+    client_id = store.id_of(client_name)
+    history = store.history
+    now = datetime.now()
+    month_start = int(now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp())
+    visits = history.events(client_id, ClientHistory.ATTEND)
+    payments = history.events(client_id, ClientHistory.PAYMENT)
+    
+    message = f"📅 История: {client_name}\n\n"
+    message += f"Посещений всего: {len(visits)}\n"
+    message += f"Посещений в этом месяце: {history.count(client_id, ClientHistory.ATTEND, month_start)}\n"
+    
+    if visits:
+        last_visit = datetime.fromtimestamp(visits[-1])
+        message += f"Последнее посещение: {last_visit.strftime('%d.%m.%Y')} ({(now - last_visit).days} дн. назад)\n"
+        weekdays = history.weekday_counts(client_id)
+        message += "По дням недели: " + ", ".join(
+            f"{day} {count}" for day, count in zip(WEEKDAY_NAMES, weekdays) if count
+        ) + "\n"
+        message += "\nПоследние посещения:\n"
+        message += "".join(
+            f"• {datetime.fromtimestamp(moment).strftime('%d.%m.%Y %H:%M')}\n" for moment in reversed(visits[-10:])
+        )
+    else:
+        message += "Посещений еще не было\n"
+    
+    if payments:
+        message += "\nОплаты:\n"
+        message += "".join(
+            f"• {datetime.fromtimestamp(moment).strftime('%d.%m.%Y')}\n" for moment in reversed(payments[-5:])
+        )
+    
+    return message
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start."""
-    print("✅ Команда /start получена!")
-    await update.message.reply_text(
-        "👯‍♀️ Учет занятий Чирлидинг (4+)\n\n"
-        "Выберите действие:",
-        reply_markup=main_menu_keyboard()
+@client_callback_route("h")
+async def show_client_history(query, context, client_name):
+    await query.edit_message_text(
+        client_history_text(client_name),
+        reply_markup=client_actions_keyboard(client_name)
     )
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на кнопки."""
-    query = update.callback_query
-    await query.answer()
+@client_callback_route("a")
+async def attend_client(query, context, client_name):
+    remaining = await mark_attendance(client_name)
     
-    callback_data = query.data
-    print(f"✅ Нажата кнопка: {callback_data}")
+    if remaining is not None:
+        message = f"✅ Посещение отмечено для {client_name}\n"
+        message += f"📊 Осталось занятий: {remaining}"
+        
+        # Предупреждение если 1 занятие
+        if remaining == REMINDER_THRESHOLD:
+            message += f"\n\n🔔 Внимание! Осталось 1 занятие"
+    else:
+        message = f"❌ Не удалось отметить посещение для {client_name}\n"
+        message += "Возможно, абонемент закончился или клиент не найден"
     
-    if callback_data == "main_menu":
-        await query.edit_message_text(
-            "👯‍♀️ Учет занятий Чирлидинг (4+)\n\nВыберите действие:",
-            reply_markup=main_menu_keyboard()
-        )
+    if client_name not in load_data():
+        # Клиента удалили, пока отмечали посещение
+        await query.edit_message_text(message, reply_markup=main_menu_keyboard())
+        return
+    await query.edit_message_text(
+        message,
+        reply_markup=client_actions_keyboard(client_name)
+    )
+
+@client_callback_route("k")
+async def check_client_sessions(query, context, client_name):
+    remaining = get_remaining_sessions(client_name)
     
-    elif callback_data == "list_clients":
-        data = load_data()
-        if not data:
-            await query.edit_message_text(
-                "📝 Список клиентов пуст.",
-                reply_markup=main_menu_keyboard()
-            )
-        else:
-            await query.edit_message_text(
-                "👥 Выберите клиента:",
-                reply_markup=clients_list_keyboard()
-            )
+    message = f"👤 Клиент: {client_name}\n"
+    message += f"📊 Осталось занятий: {remaining}"
     
-    elif callback_data == "add_client":
-        context.user_data['awaiting_client_name'] = True
-        await query.edit_message_text(
-            "👤 Добавление нового клиента\n\n"
-            "Введите имя нового клиента:",
-            reply_markup=back_to_main_menu_keyboard()
-        )
+    if remaining == REMINDER_THRESHOLD:
+        message += f"\n\n🔔 Внимание! Осталось 1 занятие"
     
-    elif callback_data == "statistics":
-        data = load_data()
-        total_clients = len(data)
-        total_sessions = sum(client_data['sessions'] for client_data in data.values())
-        
-        # Клиенты с 1 занятием
-        clients_with_one_session = []
-        for client_name, client_data in data.items():
-            if client_data['sessions'] == REMINDER_THRESHOLD:
-                clients_with_one_session.append(client_name)
-        
-        message = "📊 Статистика:\n\n"
-        message += f"Всего клиентов: {total_clients}\n"
-        message += f"Всего занятий в абонементах: {total_sessions}\n"
-        
-        if clients_with_one_session:
-            message += f"\n🔔 Клиентов с 1 занятием: {len(clients_with_one_session)}\n"
-            for client_name in clients_with_one_session[:5]:
-                message += f"• {client_name}\n"
-            if len(clients_with_one_session) > 5:
-                message += f"... и еще {len(clients_with_one_session) - 5}\n"
-        
+    await query.edit_message_text(
+        message,
+        reply_markup=client_actions_keyboard(client_name)
+    )
+
+@client_callback_route("s")
+async def ask_sessions_count(query, context, client_name):
+    context.user_data['add_sessions_client'] = client_name
+    context.user_data['awaiting_sessions_count'] = True
+    await query.edit_message_text(
+        f"➕ Добавление занятий для {client_name}\n\n"
+        "Введите количество занятий для добавления:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Назад", callback_data=f"c:{store.id_of(client_name)}")]
+        ])
+    )
+
+@client_callback_route("d")
+async def ask_delete_client(query, context, client_name):
+    await query.edit_message_text(
+        f"🗑️ Вы действительно хотите удалить клиента {client_name}?\n\n"
+        "⚠️ Это действие нельзя отменить!",
+        reply_markup=delete_confirmation_keyboard(client_name)
+    )
+
+@client_callback_route("x")
+async def confirm_delete_client(query, context, client_name):
+    if await delete_client(client_name):
         await query.edit_message_text(
-            message,
+            f"✅ Клиент {client_name} успешно удален!",
             reply_markup=main_menu_keyboard()
         )
-    
-    elif callback_data == "test_reminders":
-        sent_count = await send_reminders(context.application)
-        if sent_count > 0:
-            message = f"✅ Тестовые напоминания отправлены для {sent_count} клиентов"
-        else:
-            message = "✅ Нет клиентов с 1 занятием для напоминаний"
-        
+    else:
         await query.edit_message_text(
-            message,
+            f"❌ Ошибка при удалении клиента {client_name}",
             reply_markup=main_menu_keyboard()
         )
-    
-    elif callback_data.startswith("client_"):
-        client_name = callback_data[7:]
-        remaining = get_remaining_sessions(client_name)
-        
-        await query.edit_message_text(
-            f"👤 Клиент: {client_name}\n"
-            f"📊 Осталось занятий: {remaining}\n\n"
-            "Выберите действие:",
-            reply_markup=client_actions_keyboard(client_name)
-        )
-    
-    elif callback_data.startswith("info_"):
-        client_name = callback_data[5:]
-        client_info = get_client_info(client_name)
-        
-        if client_info:
-            message = f"👤 Информация о клиенте:\n\n"
-            message += f"Имя: {client_name}\n"
-            message += f"Занятий: {client_info['sessions']}\n"
-            
-            if client_info['last_payment_date']:
-                payment_date = datetime.fromisoformat(client_info['last_payment_date'])
-                message += f"Последняя оплата: {payment_date.strftime('%d.%m.%Y')}\n"
-            
-            if client_info.get('last_attendance'):
-                last_attendance = datetime.fromisoformat(client_info['last_attendance'])
-                message += f"Последнее посещение: {last_attendance.strftime('%d.%m.%Y')}\n"
-            
-            if client_info['phone']:
-                message += f"Телефон: {client_info['phone']}\n"
-            
-            if client_info['notes']:
-                message += f"Заметки: {client_info['notes']}\n"
-        else:
-            message = f"❌ Клиент {client_name} не найден"
-        
+
+def checkin_selection(context):
+    """id клиентов, выбранных для групповой отметки."""
+    return context.user_data.setdefault('checkin_selected', set())
+
+def group_checkin_summary(marked, skipped):
+    """Итог групповой отметки: у кого остается 1 занятие, у кого закончился абонемент."""
+    lines = [f"✅ Посещение отмечено: {len(marked)}"]
+    sections = (
+        ("🔔 Осталось 1 занятие:", [name for name, remaining in marked if remaining == REMINDER_THRESHOLD]),
+        ("❌ Абонемент закончился:", [name for name, remaining in marked if remaining == 0]),
+        ("⚠️ Не отмечены (нет занятий или клиент удален):", skipped),
+    )
+    for header, names in sections:
+        if names:
+            lines.append("")
+            lines.append(header)
+            lines.extend(f"• {client_name}" for client_name in names)
+    return "\n".join(lines)
+
+async def show_checkin_selection(query, context, page):
+    selected = checkin_selection(context)
+    page = min(page, store.page_count(CLIENTS_PAGE_SIZE) - 1)
+    await query.edit_message_text(
+        f"☑️ Отметьте присутствующих (страница {page + 1} из {store.page_count(CLIENTS_PAGE_SIZE)}, "
+        f"выбрано: {len(selected)}):",
+        reply_markup=checkin_select_keyboard(selected, page)
+    )
+
+@callback_route("g")
+async def show_checkin_groups(query, context, arg):
+    if checkin_groups.groups or store.groups():
+        message = "👥 Групповая отметка\n\nВыберите группу или отметьте клиентов вручную:"
+    else:
+        message = "👥 Групповая отметка\n\nСохраненных групп пока нет. Выберите клиентов вручную:"
+    await query.edit_message_text(
+        message,
+        reply_markup=checkin_groups_keyboard()
+    )
+
+@callback_route("gs")
+async def select_checkin_page(query, context, arg):
+    if not load_data():
         await query.edit_message_text(
-            message,
-            reply_markup=client_actions_keyboard(client_name)
+            "📝 Список клиентов пуст.",
+            reply_markup=main_menu_keyboard()
         )
-    
-    elif callback_data.startswith("attend_"):
-        client_name = callback_data[7:]
-        remaining = mark_attendance(client_name)
-        
-        if remaining is not None:
-            message = f"✅ Посещение отмечено для {client_name}\n"
-            message += f"📊 Осталось занятий: {remaining}"
-            
-            # Предупреждение если 1 занятие
-            if remaining == REMINDER_THRESHOLD:
-                message += f"\n\n🔔 Внимание! Осталось 1 занятие"
-        else:
-            message = f"❌ Не удалось отметить посещение для {client_name}\n"
-            message += "Возможно, абонемент закончился или клиент не найден"
-        
+        return
+    await show_checkin_selection(query, context, int(arg) if arg.isdigit() else 0)
+
+@callback_route("gt")
+async def toggle_checkin_client(query, context, arg):
+    client_id, _, page = arg.partition(':')
+    if client_id.isdigit():
+        selected = checkin_selection(context)
+        selected ^= {int(client_id)}
+    await show_checkin_selection(query, context, int(page) if page.isdigit() else 0)
+
+@callback_route("gc")
+async def clear_checkin_selection(query, context, arg):
+    checkin_selection(context).clear()
+    await show_checkin_selection(query, context, 0)
+
+@callback_route("gg")
+async def load_checkin_group(query, context, arg):
+    group_id = int(arg) if arg.isdigit() else None
+    if group_id not in checkin_groups.groups:
         await query.edit_message_text(
-            message,
-            reply_markup=client_actions_keyboard(client_name)
+            "❌ Группа не найдена",
+            reply_markup=checkin_groups_keyboard()
         )
-    
-    elif callback_data.startswith("check_"):
-        client_name = callback_data[6:]
-        remaining = get_remaining_sessions(client_name)
-        
-        if remaining is not None:
-            message = f"👤 Клиент: {client_name}\n"
-            message += f"📊 Осталось занятий: {remaining}"
-            
-            if remaining == REMINDER_THRESHOLD:
-                message += f"\n\n🔔 Внимание! Осталось 1 занятие"
-        else:
-            message = f"❌ Клиент {client_name} не найден"
-        
+        return
+    selected = checkin_selection(context)
+    selected.clear()
+    selected.update(store.id_of(client_name) for client_name in checkin_groups.client_names(group_id))
+    await show_checkin_selection(query, context, 0)
+
+@callback_route("gp")
+async def load_client_group(query, context, arg):
+    group = next((group for group in store.groups() if client_group_key(group) == arg), None)
+    if group is None:
         await query.edit_message_text(
-            message,
-            reply_markup=client_actions_keyboard(client_name)
+            "❌ Группа не найдена",
+            reply_markup=checkin_groups_keyboard()
         )
-    
-    elif callback_data.startswith("add_sessions_"):
-        client_name = callback_data[13:]
-        context.user_data['add_sessions_client'] = client_name
-        context.user_data['awaiting_sessions_count'] = True
+        return
+    selected = checkin_selection(context)
+    selected.clear()
+    selected.update(store.id_of(client_name) for client_name in store.group_members(group))
+    await show_checkin_selection(query, context, 0)
+
+@callback_route("gx")
+async def delete_checkin_group(query, context, arg):
+    if arg.isdigit():
+        await checkin_groups.remove(int(arg))
+    await show_checkin_groups(query, context, "")
+
+@callback_route("gv")
+async def ask_checkin_group_name(query, context, arg):
+    if not checkin_selection(context):
         await query.edit_message_text(
-            f"➕ Добавление занятий для {client_name}\n\n"
-            "Введите количество занятий для добавления:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Назад", callback_data=f"client_{client_name}")]
-            ])
+            "❌ Сначала выберите клиентов для группы",
+            reply_markup=checkin_select_keyboard(checkin_selection(context))
         )
-    
-    elif callback_data.startswith("delete_ask_"):
-        client_name = callback_data[11:]
+        return
+    context.user_data['awaiting_group_name'] = True
+    await query.edit_message_text(
+        "💾 Введите название группы:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Назад", callback_data="gs:0")]
+        ])
+    )
+
+@callback_route("ga")
+async def apply_group_checkin(query, context, arg):
+    selected = checkin_selection(context)
+    client_names = sorted(filter(None, (store.name_of(client_id) for client_id in selected)))
+    if not client_names:
         await query.edit_message_text(
-            f"🗑️ Вы действительно хотите удалить клиента {client_name}?\n\n"
-            "⚠️ Это действие нельзя отменить!",
-            reply_markup=delete_confirmation_keyboard(client_name)
+            "❌ Никто не выбран",
+            reply_markup=checkin_select_keyboard(selected)
         )
+        return
     
-    elif callback_data.startswith("delete_confirm_"):
-        client_name = callback_data[15:]
-        if delete_client(client_name):
-            await query.edit_message_text(
-                f"✅ Клиент {client_name} успешно удален!",
-                reply_markup=main_menu_keyboard()
-            )
-        else:
-            await query.edit_message_text(
-                f"❌ Ошибка при удалении клиента {client_name}",
-                reply_markup=main_menu_keyboard()
-            )
+    marked, skipped = await mark_group_attendance(client_names)
+    selected.clear()
+    await query.edit_message_text(
+        group_checkin_summary(marked, skipped),
+        reply_markup=main_menu_keyboard()
+    )
 
 # ==================== ОБРАБОТЧИК ТЕКСТОВЫХ СООБЩЕНИЙ ====================
 
+@timed('handler', handler='text_message')
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений."""
     text = update.message.text.strip()
@@ -538,7 +3110,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("❌ Имя клиента не может быть пустым")
             return
         
-        add_sessions_to_client(text, 0)
+        await add_sessions_to_client(text, 0)
         context.user_data.pop('awaiting_client_name', None)
         
         await update.message.reply_text(
@@ -556,7 +3128,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 
             client_name = context.user_data.get('add_sessions_client')
             if client_name:
-                add_sessions_to_client(client_name, sessions_to_add)
+                await add_sessions_to_client(client_name, sessions_to_add)
                 remaining = get_remaining_sessions(client_name)
                 
                 context.user_data.pop('awaiting_sessions_count', None)
@@ -571,41 +3143,473 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         except ValueError:
             await update.message.reply_text("❌ Пожалуйста, введите число")
     
+    elif context.user_data.get('awaiting_group_name'):
+        if not text:
+            await update.message.reply_text("❌ Название группы не может быть пустым")
+            return
+        
+        selected = checkin_selection(context)
+        await checkin_groups.add(text, selected)
+        context.user_data.pop('awaiting_group_name', None)
+        
+        await update.message.reply_text(
+            f"✅ Группа '{text}' сохранена ({len(selected)} клиентов)",
+            reply_markup=checkin_groups_keyboard()
+        )
+    
+    elif context.user_data.get('awaiting_client_group'):
+        if not text:
+            await update.message.reply_text("❌ Название группы не может быть пустым")
+            return
+        
+        client_name = context.user_data.pop('group_client', None)
+        context.user_data.pop('awaiting_client_group', None)
+        group = "" if text == "-" else text
+        if client_name and await set_client_group(client_name, group):
+            await update.message.reply_text(
+                f"✅ {client_name}: " + (f"группа '{group}'" if group else "без группы"),
+                reply_markup=client_actions_keyboard(client_name)
+            )
+        else:
+            await update.message.reply_text("❌ Клиент не найден", reply_markup=main_menu_keyboard())
+    
+    elif context.user_data.get('awaiting_search'):
+        if not text:
+            await update.message.reply_text("❌ Введите имя для поиска")
+            return
+        
+        context.user_data.pop('awaiting_search', None)
+        await reply_search_results(update, text)
+    
     else:
         await update.message.reply_text(
             "Используйте кнопки для работы с ботом",
             reply_markup=main_menu_keyboard()
         )
 
+# ==================== ОБРАБОТЧИК ФАЙЛОВ ====================
+
+IMPORT_ERRORS_SHOWN = 30  # Сколько ошибок перечислять в ответе на импорт
+
+def import_summary(created, updated, errors):
+    """Ответ на импорт: сколько клиентов добавлено и пополнено, ошибки по строкам."""
+    lines = [
+        "📥 Импорт завершен",
+        f"🆕 Новых клиентов: {created}",
+        f"➕ Пополнено клиентов: {updated}",
+    ]
+    if errors:
+        lines.append("")
+        lines.append(f"⚠️ Пропущено строк: {len(errors)}")
+        lines.extend(f"• строка {line_no}: {error}" for line_no, error in errors[:IMPORT_ERRORS_SHOWN])
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            lines.append(f"… и еще {len(errors) - IMPORT_ERRORS_SHOWN}")
+    return "\n".join(lines)
+
+@timed('handler', handler='document')
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Импорт клиентов из присланного CSV/XLSX-файла."""
+    document = update.message.document
+    extension = os.path.splitext(document.file_name or '')[1].lower()
+    print(f"✅ Получен файл: {document.file_name}")
+    if extension not in ('.csv', '.xlsx'):
+        await update.message.reply_text(f"❌ {IMPORT_HELP}")
+        return
+    
+    fd, path = tempfile.mkstemp(suffix=extension)
+    os.close(fd)
+    try:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(path)
+        rows, errors = await asyncio.to_thread(parse_import_file, path)
+    except ImportError:
+        await update.message.reply_text("❌ Для импорта XLSX нужен пакет openpyxl. Пришлите файл в формате CSV.")
+        return
+    except Exception as e:
+        print(f"❌ Ошибка чтения файла импорта: {e}")
+        await update.message.reply_text(f"❌ Не удалось прочитать файл. {IMPORT_HELP}")
+        return
+    finally:
+        os.remove(path)
+    
+    created, updated = await import_clients(rows) if rows else (0, 0)
+    await update.message.reply_text(
+        import_summary(created, updated, errors),
+        reply_markup=main_menu_keyboard()
+    )
+
+# ==================== HTTP-СЕРВЕР: СОСТОЯНИЕ И МЕТРИКИ ====================
+
+HTTP_ROUTES = {}  # (метод, путь) -> обработчик(application, request)
+
+class HttpRequest:
+    """Разобранный HTTP-запрос."""
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query  # Параметры строки запроса: имя -> значение
+        self.headers = headers  # Имена заголовков в нижнем регистре
+        self.body = body
+
+def http_route(path, method='GET'):
+    """Регистрирует обработчик пути: func(application, request) -> (код, тип, тело)."""
+    def register(func):
+        HTTP_ROUTES[(method, path)] = func
+        return func
+    return register
+
+HTTP_STATUSES = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                 405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+class HttpRequestError(ValueError):
+    """Запрос, на который сразу отвечают ошибкой status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+async def read_http_request(reader):
+    """Читает запрос; None, если соединение закрыто или строка запроса некорректна.
+
+    Неверный или слишком большой Content-Length - HttpRequestError.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3:
+        return None
+    method, target, _ = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HttpRequestError(400, "Некорректный Content-Length")
+    if length > HTTP_MAX_BODY:
+        raise HttpRequestError(413, "Слишком большой запрос")
+    body = await reader.readexactly(length) if length else b''
+    path, _, query = target.partition('?')
+    return HttpRequest(method, path, dict(urllib.parse.parse_qsl(query)), headers, body)
+
+async def handle_http_connection(application, reader, writer):
+    """Обслуживает одно соединение: один запрос - один ответ."""
+    try:
+        try:
+            request = await asyncio.wait_for(read_http_request(reader), HTTP_TIMEOUT)
+        except HttpRequestError as e:
+            request, response = None, (e.status, 'text/plain; charset=utf-8', str(e))
+        else:
+            if request is None:
+                return
+            # HEAD отвечает как GET, но без тела - так проверяют доступность мониторинги
+            method = 'GET' if request.method == 'HEAD' else request.method
+            handler = HTTP_ROUTES.get((method, request.path))
+            if handler is not None:
+                response = await handler(application, request)
+            elif any(path == request.path for _, path in HTTP_ROUTES):
+                response = (405, 'text/plain; charset=utf-8', "Метод не поддерживается")
+            else:
+                response = (404, 'text/plain; charset=utf-8', "Не найдено")
+        status, content_type, body = response
+        metrics.inc('http_requests_total', status=status)
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        head = (
+            f"HTTP/1.1 {status} {HTTP_STATUSES.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode('latin-1')
+        )
+        writer.write(head if request is not None and request.method == 'HEAD' else head + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        print(f"❌ Ошибка HTTP-запроса: {e}")
+    finally:
+        writer.close()
+
+async def start_http_server(application):
+    """Запускает HTTP-сервер в цикле событий бота."""
+    return await asyncio.start_server(
+        lambda reader, writer: handle_http_connection(application, reader, writer),
+        HTTP_HOST, HTTP_PORT
+    )
+
+def bot_health(application):
+    """Состояние бота: работает ли получение обновлений и планировщик."""
+    now = datetime.now()
+    if BOT_MODE == 'webhook':
+        receiving = bool(application.running)
+    else:
+        receiving = bool(application.running and application.updater is not None and application.updater.running)
+    next_runs = scheduler.next_runs()
+    # Задача, просроченная дольше SCHEDULER_STALL_SECONDS, значит, что планировщик завис
+    scheduler_ok = scheduler.running and all(
+        (now - due).total_seconds() < SCHEDULER_STALL_SECONDS for due, _ in next_runs
+    )
+    return {
+        'status': 'ok' if receiving and scheduler_ok else 'fail',
+        'mode': BOT_MODE,
+        'receiving_updates': receiving,
+        'last_update_seconds_ago': round(time.time() - metrics.last_update, 1) if metrics.last_update else None,
+        'scheduler': {
+            'running': scheduler.running,
+            'ok': scheduler_ok,
+            'next_runs': {name: due.isoformat(timespec='minutes') for due, name in next_runs},
+            'last_runs': {name: moment.isoformat(timespec='minutes') for name, moment in scheduler.last_run.items()},
+        },
+        'uptime_seconds': round(time.time() - metrics.started),
+    }
+
+@http_route('/')
+async def http_home(application, request):
+    return 200, 'text/plain; charset=utf-8', "Бот активен!"
+
+@http_route('/healthz')
+async def http_health(application, request):
+    health = bot_health(application)
+    status = 200 if health['status'] == 'ok' else 503
+    return status, 'application/json', json.dumps(health, ensure_ascii=False)
+
+@http_route('/metrics')
+async def http_metrics(application, request):
+    health = bot_health(application)
+    stats = store.stats()
+    gauges = {
+        'up': 1 if health['status'] == 'ok' else 0,
+        'updates_up': int(health['receiving_updates']),
+        'scheduler_up': int(health['scheduler']['ok']),
+        'uptime_seconds': round(time.time() - metrics.started),
+        'clients': stats['clients'],
+        'sessions': stats['sessions'],
+        'clients_at_threshold': stats['at_threshold'],
+        'clients_at_zero': stats['at_zero'],
+        'render_cache_entries': len(render_cache.entries),
+        'render_cache_hits': render_cache.hits,
+        'render_cache_misses': render_cache.misses,
+    }
+    if metrics.last_update:
+        gauges['last_update_age_seconds'] = round(time.time() - metrics.last_update, 1)
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render(gauges)
+
+@http_route('/debug/profile')
+async def http_profile(application, request):
+    """Профиль цикла событий за ?seconds=N (по умолчанию 10, не больше 60)."""
+    if not PROFILER_ENABLED:
+        return 404, 'text/plain; charset=utf-8', "Не найдено"
+    try:
+        seconds = min(float(request.query.get('seconds', 10)), 60)
+    except ValueError:
+        return 400, 'text/plain; charset=utf-8', "seconds должно быть числом"
+    try:
+        report = await profiler.profile(seconds)
+    except RuntimeError as e:
+        return 503, 'text/plain; charset=utf-8', str(e)
+    return 200, 'text/plain; charset=utf-8', report
+
+class InstrumentedBot(ExtBot):
+    """Бот, который учитывает время и ошибки отправки сообщений в метриках."""
+
+    async def send_message(self, *args, **kwargs):
+        try:
+            with metrics.timer('send_message'):
+                return await super().send_message(*args, **kwargs)
+        except Exception:
+            metrics.inc('send_message_errors_total')
+            raise
+
+@http_route(WEBHOOK_PATH, method='POST')
+async def http_webhook(application, request):
+    """Принимает обновление от Telegram и ставит его в очередь приложения."""
+    if BOT_MODE != 'webhook':
+        return 404, 'text/plain; charset=utf-8', "Не найдено"
+    secret = request.headers.get('x-telegram-bot-api-secret-token', '')
+    if not hmac.compare_digest(secret.encode('utf-8'), application.bot_data['webhook_secret'].encode('utf-8')):
+        metrics.inc('webhook_rejected_total', reason='secret')
+        return 403, 'text/plain; charset=utf-8', "Доступ запрещен"
+    try:
+        payload = json.loads(request.body)
+        if not isinstance(payload, dict):
+            raise ValueError("обновление должно быть объектом JSON")
+        update = Update.de_json(payload, application.bot)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        metrics.inc('webhook_rejected_total', reason='payload')
+        return 400, 'text/plain; charset=utf-8', "Некорректное обновление"
+    # Обрабатывается в фоне, Telegram сразу получает ответ
+    await application.update_queue.put(update)
+    return 200, 'text/plain; charset=utf-8', "ok"
+
+async def track_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Учитывает каждое обновление от Telegram (до остальных обработчиков)."""
+    metrics.last_update = time.time()
+    metrics.inc('updates_total')
+
 # ==================== ГЛАВНАЯ ФУНКЦИЯ ====================
 
-def main():
-    # Создаем Application и передаем ему токен бота
-    application = Application.builder().token(BOT_TOKEN).build()
+async def on_startup(application):
+    """Запускает HTTP-сервер состояния в цикле событий бота."""
+    application.bot_data['http_server'] = await start_http_server(application)
+
+async def on_shutdown(application):
+    """Останавливает HTTP-сервер и дожидается записи всех изменений перед остановкой бота."""
+    server = application.bot_data.pop('http_server', None)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    await store.flush()
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает до max_concurrent_updates обновлений одновременно.
+
+    Обновления одного чата выполняются строго по очереди: сначала берется
+    блокировка чата, и только потом место в общем семафоре, поэтому
+    ожидающие своей очереди нажатия не занимают места других чатов.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}  # id чата -> [блокировка, сколько обновлений ее ждут или держат]
+
+    @staticmethod
+    def _chat_id(update):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return update.effective_user.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        chat_id = self._chat_id(update)
+        if chat_id is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            entry = self._chats[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat_id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def build_application(bot):
+    """Создает Application с обработчиками бота."""
+    application = (
+        Application.builder()
+        .bot(bot)
+        .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Регистрируем обработчики
+    application.add_handler(TypeHandler(Update, track_update), group=-1)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("report", report_command))
+    application.add_handler(CommandHandler("find", find_command))
     application.add_handler(CallbackQueryHandler(handle_callback))
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND,
         handle_text_message
     ))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    return application
+
+async def run_webhook(application):
+    """Работа через вебхук: обновления принимает общий HTTP-сервер бота."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    application.bot_data['webhook_secret'] = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    await application.initialize()
+    try:
+        await on_startup(application)
+        scheduler_task = None
+        try:
+            await application.start()
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=application.bot_data['webhook_secret'],
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=CONCURRENT_UPDATES
+            )
+            print(f"✅ Вебхук установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+            scheduler_task = asyncio.create_task(schedule_tasks(application))
+            await stop.wait()
+            # Вебхук не снимаем: пока бот выключен, Telegram копит обновления и пришлет их после запуска
+        finally:
+            # И при ошибке (например, set_webhook отклонил WEBHOOK_URL) приложение
+            # останавливается до shutdown(), иначе тот скроет исходную ошибку
+            if scheduler_task is not None:
+                scheduler_task.cancel()
+                await asyncio.gather(scheduler_task, return_exceptions=True)
+            if application.running:
+                await application.stop()
+    finally:
+        await on_shutdown(application)
+        await application.shutdown()
+
+def main():
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        print("❌ Ошибка: для BOT_MODE=webhook нужен WEBHOOK_URL")
+        exit(1)
+    
+    # Создаем Application с ботом, который учитывает отправку сообщений в метриках
+    application = build_application(InstrumentedBot(BOT_TOKEN))
 
     print("🤖 Бот Cheer9 запускается...")
-    print(f"✅ Используется файл данных: {DATA_FILE}")
+    print(f"✅ Используется файл данных: {DATA_FILE} (режим хранения: {STORAGE_MODE})")
     print(f"✅ Напоминания для клиентов с: {REMINDER_THRESHOLD} занятием")
-    print(f"✅ Ежемесячные отчеты: 30-го числа (28-го в феврале) в {REPORT_HOUR}:00")
-    
-    # Запускаем фоновые задачи
-    loop = asyncio.get_event_loop()
-    loop.create_task(schedule_tasks(application))
+    print(f"✅ Напоминания по расписанию: {REMINDER_SCHEDULE}")
+    print(f"✅ Ежемесячные отчеты по расписанию: {REPORT_SCHEDULE}")
+    print(f"✅ Состояние и метрики: http://{HTTP_HOST}:{HTTP_PORT}/healthz, /metrics")
+    print(f"✅ Получение обновлений: {BOT_MODE}, одновременно до {CONCURRENT_UPDATES}")
     
-    application.run_polling()
+    try:
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(application))
+        else:
+            # Запускаем фоновые задачи
+            loop = asyncio.get_event_loop()
+            loop.create_task(schedule_tasks(application))
+            application.run_polling()
+    finally:
+        store.close()  # Записываем изменения, которые еще не попали на диск
     print("🛑 Бот остановлен")
 
 # ==================== ЗАПУСК ПРИЛОЖЕНИЯ ====================
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate-sqlite':
+        # python main.py migrate-sqlite [путь к JSON-файлу]
+        migrate_json_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else DATA_FILE)
+        sys.exit(0)
     ensure_data_file()  # Создаем файл данных если нужно
-    keep_alive()        # Запускаем веб-сервер для поддержания активности
+    store.load()        # Загружаем клиентов в память один раз
+    checkin_groups.load()
     main()              # Запускаем бота
\ No newline at end of file
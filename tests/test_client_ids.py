@@ -0,0 +1,112 @@
+"""id удаленного клиента не выдается снова, в том числе после перезапуска."""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('BOT_TOKEN', '123456:test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+STORAGES = {
+    'json': lambda save_delay: main.JsonFileStorage(save_delay),
+    'journal': lambda save_delay: main.JournalStorage(main.JOURNAL_COMPACT_BYTES),
+    'sqlite': lambda save_delay: main.SqliteStorage(main.SQLITE_FILE),
+    'sharded': lambda save_delay: main.ShardedStorage(main.SHARDS_DIR, save_delay),
+}
+
+def open_store(backend, save_delay=0):
+    store = main.ClientStore(STORAGES[backend](save_delay), main.ClientHistory(main.HISTORY_FILE))
+    store.load()
+    return store
+
+def crash(store):
+    """Останавливает хранилище как при падении процесса: без снимка при закрытии."""
+    store._executor.shutdown(wait=True)
+    store.history.close()
+    store.storage.close()
+
+async def add_client(store, client_name):
+    store.insert(client_name, main.Client(4, 1))
+    await store.record('topup', client_name)
+    return store.id_of(client_name)
+
+async def delete_client(store, client_name):
+    store.remove(client_name)
+    await store.record('delete', client_name)
+
+@pytest.mark.parametrize('backend', STORAGES)
+def test_deleted_highest_id_is_not_reused_after_restart(backend, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    main.ensure_data_file()
+    store = open_store(backend)
+
+    async def fill():
+        for client_name in ('Анна', 'Борис'):
+            await add_client(store, client_name)
+        deleted_id = await add_client(store, 'Вера')
+        await delete_client(store, 'Вера')
+        await store.flush()
+        return deleted_id
+
+    deleted_id = asyncio.run(fill())
+    store.close()
+
+    store = open_store(backend)
+    try:
+        new_id = asyncio.run(add_client(store, 'Галина'))
+        assert new_id > deleted_id
+        assert store.name_of(deleted_id) is None
+    finally:
+        store.close()
+
+@pytest.mark.parametrize('backend', STORAGES)
+def test_id_of_client_deleted_before_snapshot_is_not_reused(backend, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    main.ensure_data_file()
+    store = open_store(backend)
+
+    async def fill():
+        await add_client(store, 'Анна')
+        await store.flush()
+        # Клиент добавлен и удален между снимками
+        deleted_id = await add_client(store, 'Борис')
+        await delete_client(store, 'Борис')
+        await store.flush()
+        return deleted_id
+
+    deleted_id = asyncio.run(fill())
+    store.close()
+
+    store = open_store(backend)
+    try:
+        assert asyncio.run(add_client(store, 'Вера')) > deleted_id
+    finally:
+        store.close()
+
+@pytest.mark.parametrize('backend', STORAGES)
+def test_id_of_client_lost_before_snapshot_is_not_reused(backend, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    main.ensure_data_file()
+    store = open_store(backend, save_delay=60)
+
+    async def fill():
+        client_id = await add_client(store, 'Анна')
+        store.set_attendance_date('Анна', main.datetime.now())
+        await store.record('attend', 'Анна')
+        return client_id
+
+    # Процесс падает раньше, чем снимок успевает записать Анну
+    lost_id = asyncio.run(fill())
+    crash(store)
+
+    store = open_store(backend)
+    try:
+        new_id = asyncio.run(add_client(store, 'Борис'))
+        assert new_id != lost_id
+        assert store.history.count(new_id, main.ClientHistory.ATTEND) == 0
+    finally:
+        store.close()